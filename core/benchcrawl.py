@@ -0,0 +1,119 @@
+"""
+Crawler benchmark
+------------------------------------
+Serve canned Pantip pages from a local stub HTTP server
+and compare the sequential scraper with the concurrent crawler.
+
+  $ python3 core/benchcrawl.py --n 500 --latency 50 --concurrency 32
+  $ python3 core/benchcrawl.py --pages data/pages/
+
+Saved pages are read from the HTML cache directory (see `fetch --cache`)
+or from files named `<topic_id>.html`, otherwise a single
+built-in sample page is served for every id.
+
+@starcolon projects
+"""
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from termcolor import colored
+import threading
+import argparse
+import time
+import sys
+import os
+
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--pages', type=str, default=None) # Directory of saved pages
+arguments.add_argument('--n', type=int, default=200) # Number of topics to crawl
+arguments.add_argument('--latency', type=int, default=20) # Simulated server latency (ms)
+arguments.add_argument('--concurrency', type=int, default=16) # In-flight downloads
+arguments.add_argument('--parsers', type=int, default=0) # HTML parser processes
+arguments.add_argument('--port', type=int, default=9870) # Stub server port
+
+SAMPLE_PAGE = """<html><head><title>Pantip</title></head><body>
+<div class="display-post-wrapper">
+  <h2 class="display-post-title">ทดสอบกระทู้</h2>
+  <div class="display-post-story">เนื้อหากระทู้ทดสอบ สำหรับวัดความเร็ว</div>
+  <div class="display-post-tag-wrapper">
+<a class="tag-item">ทดสอบ</a>
+<a class="tag-item">กระทู้</a>
+  </div>
+  <span class="like-score">12</span>
+  <span class="emoticon-score">5</span>
+  <div class="emotion-vote-user">ถูกใจ ถูกใจ ขำกลิ้ง ซึ้ง</div>
+</div>
+</body></html>"""
+
+
+class StubServer(ThreadingMixIn,HTTPServer):
+  daemon_threads = True
+
+def make_handler(pages,latency):
+  class PantipStub(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive
+
+    def do_GET(self):
+      topic_id = self.path.rstrip('/').split('/')[-1]
+      body     = pages.get(topic_id,pages.get(None,'')).encode('utf-8')
+      time.sleep(latency/1000.0)
+      self.send_response(200)
+      self.send_header('Content-Type','text/html; charset=utf-8')
+      self.send_header('Content-Length',str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self,*args):
+      pass
+  return PantipStub
+
+def load_pages(path):
+  pages = {}
+  if path is None:
+    pages[None] = SAMPLE_PAGE
+    return pages
+  if os.path.isfile(os.path.join(path,'index.jsonl')):
+    from pypantip import htmlcache
+    cache = htmlcache.HtmlCache(path)
+    return {str(k): cache.get(k) for k in cache.topics()}
+  for name in os.listdir(path):
+    if name.endswith('.html'):
+      with open(os.path.join(path,name),encoding='utf-8') as f:
+        pages[name[:-5]] = f.read()
+  return pages
+
+def report(title,n,elapsed):
+  print(colored(title.ljust(12),'cyan'),
+    '{0} topics in {1:.2f} s ({2:.1f} topics/s)'.format(n,elapsed,n/elapsed))
+
+
+if __name__ == '__main__':
+  args  = vars(arguments.parse_args(sys.argv[1:]))
+  pages = load_pages(args['pages'])
+  ids   = [int(k) for k in pages if k is not None][:args['n']] \
+          or list(range(1,args['n']+1))
+
+  # Start the stub server in background
+  server = StubServer(('127.0.0.1',args['port']),make_handler(pages,args['latency']))
+  threading.Thread(target=server.serve_forever,daemon=True).start()
+  os.environ['PANTIP_URL'] = 'http://127.0.0.1:{0}'.format(args['port'])
+
+  from pypantip import scraper
+  from pypantip import crawler
+  scraper.PANTIP_URL = os.environ['PANTIP_URL']
+
+  # Sequential scraping (baseline)
+  t0 = time.time()
+  for _id in ids: scraper.scrape(_id)
+  report('sequential',len(ids),time.time()-t0)
+
+  # Concurrent crawling
+  summary = crawler.crawl(
+    ids,
+    store=lambda doc: None,
+    concurrency=args['concurrency'],
+    parsers=args['parsers']
+  )
+  report('concurrent',summary['stored'],summary['elapsed'])
+
+  server.shutdown()
@@ -0,0 +1,51 @@
+"""
+HTML extraction benchmark
+------------------------------------
+Compare the htmldom extractor with the single-pass
+streaming extractor on the saved pages, and verify
+both produce identical scrape records.
+
+  $ python3 core/benchscrape.py --pages data/pages --repeat 3
+
+Saved pages are read from the HTML cache directory (see `fetch --cache`)
+or from files named `<topic_id>.html`, otherwise the built-in
+sample page is used.
+
+@starcolon projects
+"""
+
+from pypantip import scraper
+from pypantip import streamscraper
+from termcolor import colored
+import benchcrawl
+import argparse
+import time
+import sys
+
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--pages', type=str, default=None) # Directory of saved pages
+arguments.add_argument('--repeat', type=int, default=1) # Number of passes over the pages
+
+def measure(title,extract,pages,repeat):
+  t0 = time.process_time()
+  for _ in range(repeat):
+    out = {k: extract(k,html) for k,html in pages.items()}
+  elapsed = time.process_time() - t0
+  n = len(pages)*repeat
+  print(colored(title.ljust(8),'cyan'),
+    '{0} pages in {1:.2f} s CPU ({2:.2f} ms/page)'.format(n,elapsed,1000*elapsed/n))
+  return out
+
+if __name__ == '__main__':
+  args  = vars(arguments.parse_args(sys.argv[1:]))
+  pages = benchcrawl.load_pages(args['pages'])
+
+  dom    = measure('dom',lambda k,html: scraper.scrape_html(k,html,engine='dom'),pages,args['repeat'])
+  stream = measure('stream',streamscraper.extract,pages,args['repeat'])
+
+  # Both engines must agree on every page
+  mismatches = [k for k in pages if dom[k]!=stream[k]]
+  if mismatches:
+    print(colored('{0} mismatched pages : {1}'.format(len(mismatches),mismatches[:10]),'red'))
+  else:
+    print(colored('All records identical','green'))
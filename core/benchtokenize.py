@@ -0,0 +1,52 @@
+"""
+Tokeniser benchmark
+------------------------------------
+Tokenise the same corpus through the tokenizer.rb
+service (HTTP) and the in-process word breaker,
+and report their speed and agreement.
+
+  $ ruby core/tokenizer/tokenizer.rb &
+  $ python3 core/benchtokenize.py --corpus corpus.txt --dict data/words/dict.trie
+
+The corpus is a text file, one text per line.
+
+@starcolon projects
+"""
+
+from pypipe.operations import tokenizer
+from termcolor import colored
+import argparse
+import time
+import sys
+
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--corpus', type=str, required=True) # Text file, one text per line
+arguments.add_argument('--dict', type=str, default=tokenizer.DICT_PATH) # Compiled dictionary
+arguments.add_argument('--batch', type=int, default=64) # Texts per HTTP request
+arguments.add_argument('--skip-http', dest='skip_http', action='store_true') # Only run the in-process backend
+
+def measure(title,texts,batch):
+  t0 = time.time()
+  words = []
+  for i in range(0,len(texts),batch):
+    words += tokenizer.tokenize_many(texts[i:i+batch])
+  elapsed = time.time() - t0
+  print(colored(title.ljust(8),'cyan'),
+    '{0} texts in {1:.2f} s ({2:.1f} texts/s)'.format(len(texts),elapsed,len(texts)/elapsed))
+  return words
+
+if __name__ == '__main__':
+  args = vars(arguments.parse_args(sys.argv[1:]))
+  with open(args['corpus'],encoding='utf-8') as f:
+    texts = [line.strip() for line in f if len(line.strip())>0]
+
+  tokenizer.use('python',args['dict'])
+  words_py = measure('python',texts,args['batch'])
+
+  if not args['skip_http']:
+    tokenizer.use('http')
+    tokenizer.configure(batch_size=args['batch'])
+    words_http = measure('http',texts,args['batch'])
+
+    same = len([1 for a,b in zip(words_py,words_http) if a==b])
+    print(colored('{0:.2f}% of the texts tokenised identically'.format(100*same/len(texts)),'green'))
@@ -7,13 +7,13 @@ import os
 import sys
 import json
 import argparse
-import subprocess
 import numpy as np
 from flask import Flask, request
 from termcolor import colored
 from pprint import pprint
 from pypipe import pipe as Pipe
 from pypipe import datapipe as DP
+from pypipe import profiling
 from pypipe.operations import rabbit
 from pypipe.operations import tapper as T
 from pypipe.operations import cluster
@@ -21,6 +21,7 @@ from pypipe.operations import taghasher
 from pypipe.operations import texthasher
 from pypipe.operations import textcluster
 from pypipe.operations import preprocess
+from pypipe.operations import tokenpool
 
 REPO_DIR = os.getenv('PANTIPLIBR','../..')
 TEXT_VECTORIZER_PATH  = '{0}/data/models/vectoriser'.format(REPO_DIR)
@@ -42,9 +43,9 @@ class Classifier:
 
   def classify(self,topic):
     # Prepare processing functions
-    hashMe     = texthasher.hash(self.topicHasher,learn=False)
-    hashtagMe  = taghasher.hash(self.tagHasher,learn=False)
-    classifyMe = cluster.analyze(self.clf)
+    hashMe     = profiling.wrap('Vectorisation',texthasher.hash(self.topicHasher,learn=False))
+    hashtagMe  = profiling.wrap('Tag Vectorising',taghasher.hash(self.tagHasher,learn=False))
+    classifyMe = profiling.wrap('Classification',cluster.analyze(self.clf))
 
     v = hashMe(str(topic['title'] + topic['topic']))
     t = ' '.join([tag for tag in topic['tags'] if len(tag)>1])
@@ -77,7 +78,6 @@ class ErrorResponse(Exception):
 # Server lifetime-wide variables
 clf         = Classifier()
 ALL_ATTRS   = ['title','topic','tags']
-workers     = []
 
 def try_parse(req):
   try:
@@ -100,7 +100,8 @@ def classify_req(topic):
   print(colored('Classifying: ','cyan'))
 
   # Apply preprocessing
-  topic = preprocess.take(topic)
+  with profiling.stage('Preprocess'):
+    topic = preprocess.take(topic)
   pprint(topic)
   c = next(clf.classify(topic))
   print(colored('#CLASS : ${}'.format(c),'cyan'))
@@ -137,31 +138,23 @@ def classify():
     return encap_resp(req,classify_req(req))
 
 
-def run_tokeniser():
-  global workers
-  script = 'ruby {0}/core/tokenizer/tokenizer.rb'.format(REPO_DIR)
-  print(colored('🚀 Executing...','green') + script)
-  sp = subprocess.Popen(script, 
-    shell=True, stdout=subprocess.PIPE,
-    preexec_fn=os.setsid)
-  workers.append(sp)
-
-def end_worker(sp):
-  print(colored('Ending worker pid#${}'.format(sp.pid),'green'))
-  subprocess.Popen('kill {0}'.format(sp.pid),
-    shell=True, stdout=subprocess.PIPE)
-
 if __name__ == '__main__':
 
-  global workers
+  arguments = argparse.ArgumentParser()
+  arguments.add_argument('--profile', type=str, default=None) # Write the stage profiles into this directory
+  arguments.add_argument('--profile-mode', dest='profile_mode', type=str, default='cprofile') # [cprofile] or [sample]
+  args = vars(arguments.parse_args(sys.argv[1:]))
+  if args['profile']:
+    profiling.enable(args['profile'],args['profile_mode'])
 
-  # Execute text tokeniser service in background
-  run_tokeniser()
+  # Execute the pool of text tokenisers in background
+  # (TOKENIZER_WORKERS sets the number of workers)
+  tokenisers = tokenpool.start()
 
   print(colored('Classification microservice STARTED...','magenta'))
   app.run(host='0.0.0.0', port=1996)
   print(colored('Classification microservice ENDED...','magenta'))
 
   # End all workers (tokeniser)
-  [end_worker(sp) for sp in workers]
+  tokenisers.end()
 
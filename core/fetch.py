@@ -7,31 +7,112 @@ and push them into CouchDB
 """
 
 from pypantip import scraper
+from pypantip import crawler
+from pypantip import ledger as Ledger
+from pypantip import htmlcache
 from pydb import couch
 from pprint import pprint
 from termcolor import colored
+import argparse
 import json
+import sys
+import os
 
-def scrape_and_store(topic_id):
-  thread = scraper.scrape(_id)
-  if thread is None: return False # Skip if thread scraping failed
+REPO_DIR    = os.getenv('PANTIPLIBR','.')
+LEDGER_PATH = '{0}/data/crawl-ledger.json'.format(REPO_DIR)
+CACHE_PATH  = '{0}/data/pages'.format(REPO_DIR)
+
+# Prepare fetching arguments
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--start', type=int, default=34847792) # First topic ID
+arguments.add_argument('--end', type=int, default=34847792) # Last topic ID (exclusive)
+arguments.add_argument('--concurrency', type=int, default=0) # Number of in-flight downloads (0 = sequential)
+arguments.add_argument('--parsers', type=int, default=0) # Number of HTML parser processes
+arguments.add_argument('--engine', type=str, default=scraper.ENGINE) # HTML extraction engine: dom, stream
+arguments.add_argument('--ledger', type=str, default=LEDGER_PATH) # Crawl ledger file
+arguments.add_argument('--retry', dest='retry', action='store_true') # Only retry the failed ids
+arguments.add_argument('--cache', dest='cache', action='store_true') # Keep the raw pages in the HTML cache
+arguments.add_argument('--replay', dest='replay', action='store_true') # Re-extract the cached pages (no network)
+arguments.add_argument('--cachedir', type=str, default=CACHE_PATH) # HTML cache directory
+arguments.add_argument('--cachesize', type=float, default=8) # HTML cache size limit (GB)
+arguments.add_argument('--db', type=str, default='pantip') # CouchDB database to store the topics
+
+def scrape_and_store(writer,ledger,topic_id,engine,cache=None,replay=False):
+  try:
+    thread = scraper.scrape(topic_id,engine,cache,replay)
+  except Exception as e:
+    print(colored('FAILED #{0} : {1}'.format(topic_id,e),'red'))
+    ledger.mark_failed(topic_id)
+    return False
+
+  if thread is None: # Skip the deleted thread
+    ledger.mark_deleted(topic_id)
+    return False
 
   print(thread)
 
-  # Save the scraped document
+  # Save the scraped document,
+  # the writer marks it stored once it is saved
   print(colored('Saving ...','yellow'))
-  couch.push(db,thread)
+  writer.push(thread)
 
   return True
 
 if __name__ == '__main__':
+  args = vars(arguments.parse_args(sys.argv[1:]))
+
   # Prepare the database server connection
-  db = couch.connector('pantip')
+  db = couch.connector(args['db'])
+
+  # Resume from the previous crawls
+  ledger = Ledger.safe_load(args['ledger'])
 
-  # Fetch the threads in the specified range
+  # Raw HTML cache
+  cache  = None
+  if args['cache'] or args['replay']:
+    cache = htmlcache.HtmlCache(args['cachedir'],int(args['cachesize']*htmlcache._1GB))
+
+  # Save the scraped documents in bulk
+  writer = couch.BulkWriter(
+    db,
+    on_failed=lambda thread,e: ledger.mark_failed(thread['topic_id']),
+    on_stored=lambda thread,rev: ledger.mark_stored(thread['topic_id'])
+  )
+
+  # Fetch the threads in the specified range,
+  # or only those failed previously
   num = 0
-  for _id in range(34847792,34847792):
-    if scrape_and_store(_id): num += 1
+  if args['replay']:
+    # Re-extract every cached page (in the range, if given) regardless of the ledger
+    # NOTE: Better [--db] to a separate database to avoid duplicates
+    ids = [i for i in cache.topics()
+           if args['end']<=args['start'] or args['start']<=i<args['end']]
+    ledger = Ledger.Ledger(args['ledger'] + '.replay')
+  elif args['retry']:
+    ids = list(ledger.failed)
+  else:
+    ids = range(args['start'],args['end'])
+
+  if args['concurrency']>0:
+    summary = crawler.crawl(
+      ids,
+      store=writer.push,
+      concurrency=args['concurrency'],
+      parsers=args['parsers'],
+      ledger=ledger,
+      engine=args['engine'],
+      cache=cache,
+      replay=args['replay'],
+      buffered=True
+    )
+    pprint(summary)
+    num = summary['stored']
+  else:
+    for _id in ledger.pending(ids):
+      if scrape_and_store(writer,ledger,_id,args['engine'],cache,args['replay']): num += 1
+
+  writer.close()
+  ledger.save()
 
   print(colored('=============================','cyan'))
   print(colored('  {0} documents processed'.format(num),'cyan'))
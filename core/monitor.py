@@ -18,90 +18,211 @@ from pypipe import pipe as Pipe
 from pypipe.operations import preprocess
 from pypipe.operations import wordbag
 from pypipe.operations import rabbit
+from pypipe.operations import tokenpool
 import textprocess
-import subprocess
+import multiprocessing
+import argparse
 import signal
+import math
+import gc
 import json
 import time
 import sys
 import os
 
-workers   = []
 REPO_DIR  = os.getenv('PANTIPLIBR','.')
 MQ_INPUT  = 'feed-in'
 MQ_OUTPUT = 'feed-out'
 
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--batch', type=int, default=64) # Messages classified at once
+arguments.add_argument('--linger', type=int, default=50) # Longest wait (ms) for a batch to fill up
+arguments.add_argument('--workers', type=int, default=0) # Number of forked consumers (0: consume in this process)
+arguments.add_argument('--autoscale', dest='autoscale', action='store_true') # Scale the consumers with the depth of the input MQ
+arguments.add_argument('--min-workers', dest='min_workers', type=int, default=1)
+arguments.add_argument('--max-workers', dest='max_workers', type=int, default=os.cpu_count() or 1)
+arguments.add_argument('--backlog', type=int, default=500) # Queued messages per consumer before scaling up
+
+# Pool of background tokenisers
+tokenisers = None
+
+# Pool of forked consumers
+pool = None
+
 # Text classification models
-topicHasher,taghasher,contentClf,clf = None,None,None,None
+topicHasher,tagHasher,clf = None,None,None
 classify = lambda x:x # Eta expansion
 
-def execute_background_services():
-  global workers
-  services = ['ruby {0}/core/tokenizer/tokenizer.rb'.format(REPO_DIR)]
+# Parse a requested message and check its fields
+# @return {tuple} of (topic, reason it is rejected or None)
+def parse_message(msg):
+  try:
+    topic = json.loads(msg)
+  except ValueError:
+    return None,'unparsable JSON'
+  if not isinstance(topic,dict):
+    return None,'not a JSON object'
+  for field in ['title','topic']:
+    if not isinstance(topic.get(field),str):
+      return topic,'[{0}] must be a string'.format(field)
+  tags = topic.get('tags')
+  if not isinstance(tags,list) or not all(isinstance(t,str) for t in tags):
+    return topic,'[tags] must be a list of strings'
+  return topic,None
 
-  workers = []
-  for s in services:
-    print('Executing: {0}'.format(s))
-    sp = subprocess.Popen(
-      s,
-      shell=True,
-      stdout=subprocess.PIPE,
-      preexec_fn=os.setsid
-    )
-    workers.append(sp)
+# Event handler: A batch of requested messages received
+# A message which is not a valid topic is rejected on its own,
+# the rest of the batch is still analysed.
+# @param {list} of JSON messages
+# @return {tuple} of (analysed topics, rejected messages)
+def on_phone_ring(msgs):
+  print(colored('[MSG] ','magenta'), '{0} messages'.format(len(msgs)))
+  topics,rejected = [],[]
+  for msg in msgs:
+    topic,error = parse_message(msg)
+    if error is None:
+      topics.append(topic)
+      continue
+    print(colored('Message rejected ({0}): '.format(error),'red'), msg[:80])
+    rejected.append({'id': topic.get('id') if isinstance(topic,dict) else None, 'error': error})
 
-  return workers
+  # Preprocess the messages (tokenisation) in one go
+  topics = preprocess.take_many(topics)
 
+  # Analyse
+  ys = classify(topics)
+  for y,topic in zip(ys,topics):
+    topic['class'] = y.item() if hasattr(y,'item') else y
+    print(colored(topic['class'],"red"), " --> ", topic['title'])
 
-# Event handler: An incoming requested message received
-def on_phone_ring(msg):
-  print(colored('[MSG] ','magenta'), msg)
-  # Preprocess the message (tokenisation)
-  topic  = json.loads(msg)
-  _topic = preprocess.take(topic)
+  return topics,rejected
 
-  # Stringify those JSON first 
-  # TAODEBUG: It shouldn't be JSON stringify now, double effort
-  _topic = json.dumps(_topic,ensure_ascii=False)
+# Pack the analysis results for the output MQ,
+# the rejected messages get an error result
+def publish_output(feed,topics,rejected=[]):
+  for topic in topics:
+    feed({
+      'id':    topic.get('id'),
+      'title': topic['title'],
+      'class': topic['class']
+    })
+  for r in rejected: feed(r)
+  feed.flush()
 
-  # Analyse
-  (y,x) = classify([_topic])
-  
-  #TAODEBUG:
-  print(colored('[ANALYSED]','magenta'))
-  print(colored(y,"red"), " --> ", _topic['title'])
-
-  return y
-
-def publish_output(feeders,messageid,output):
-  feed = rabbit.feed([feeders])
-  pack = {
-    id: messageid,
-    out: output
-  }
-  feed(pack)
+# Classify the incoming messages in batches of up to [batch],
+# each waiting no longer than [linger] seconds to fill up.
+# A batch is acknowledged once its results are published,
+# along with the error results of its rejected messages.
+# @param {Function} until, the monitoring ends once it returns True
+def monitor(mqinput,mqoutput,batch=64,linger=0.05,until=None):
+  feed = rabbit.feed([mqoutput],batch_size=batch)
+  for msgs in rabbit.iter(mqinput,timeout=None,prefetch=2*batch,chunk=batch,linger=linger,until=until):
+    publish_output(feed,*on_phone_ring(msgs))
+
+
+# Consumer process forked from the parent, sharing its
+# loaded models copy-on-write. On SIGTERM it finishes the
+# batch at hand, acknowledges it and leaves the rest
+# of its prefetched messages to the other consumers.
+def consume(batch,linger):
+  stopping = []
+  signal.signal(signal.SIGTERM, lambda signum,frame: stopping.append(signum))
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # The parent handles it
+
+  # Connections and caches of its own
+  preprocess.use_cache()
+  mqinput  = rabbit.create('localhost',MQ_INPUT)
+  mqoutput = rabbit.create('localhost',MQ_OUTPUT)
+  try:
+    monitor(mqinput,mqoutput,batch,linger,until=lambda: len(stopping)>0)
+  finally:
+    rabbit.end_multiple([mqoutput,mqinput])
+  print(colored('Consumer #{0} drained'.format(os.getpid()),'yellow'))
+
+# Supervised pool of forked consumers
+class MonitorPool(object):
+  def __init__(self,n=1,batch=64,linger=0.05,autoscale=False,
+    min_workers=1,max_workers=4,backlog=500,check_every=2):
+    self.n           = n
+    self.batch       = batch
+    self.linger      = linger
+    self.autoscale   = autoscale
+    self.min_workers = min_workers
+    self.max_workers = max(min_workers,max_workers)
+    self.backlog     = backlog
+    self.check_every = check_every
+    self.workers     = [] # Running consumers
+    self.draining    = [] # Consumers asked to stop
+    self.stopping    = False
+    self.context     = multiprocessing.get_context('fork')
+
+  def __spawn(self):
+    p = self.context.Process(target=consume,args=(self.batch,self.linger))
+    p.start()
+    self.workers.append(p)
+    print(colored('🚀 Consumer #{0} started ({1} running)'.format(p.pid,len(self.workers)),'green'))
+
+  def __retire(self):
+    p = self.workers.pop()
+    p.terminate() # SIGTERM, the consumer drains
+    self.draining.append(p)
+    print(colored('Consumer #{0} retiring ({1} running)'.format(p.pid,len(self.workers)),'yellow'))
+
+  # Number of consumers needed for the queued messages
+  def desired(self,mqinput):
+    if not self.autoscale: return self.n
+    depth = mqinput.channel.queue_declare(queue=MQ_INPUT,passive=True).method.message_count
+    need  = math.ceil(depth/self.backlog) if depth>0 else self.min_workers
+    return min(self.max_workers,max(self.min_workers,need))
+
+  # Keep the pool at its size until stopped
+  def run(self,mqinput):
+    # The models stay out of the garbage collector's reach,
+    # so the consumers do not copy their pages on collection
+    gc.freeze()
+    for _ in range(self.n if not self.autoscale else self.min_workers): self.__spawn()
+
+    while not self.stopping:
+      # Keeps the connection to the broker alive meanwhile
+      mqinput.conn.sleep(self.check_every)
+      if self.stopping: break
+      # Replace the consumers which died
+      for p in [p for p in self.workers if not p.is_alive()]:
+        print(colored('Consumer #{0} exited ({1}), restarting...'.format(p.pid,p.exitcode),'red'))
+        self.workers.remove(p)
+      self.draining = [p for p in self.draining if p.is_alive()]
+
+      n = self.desired(mqinput)
+      while len(self.workers)<n: self.__spawn()
+      while len(self.workers)>n: self.__retire()
+
+  # Stop all the consumers and wait until they drain
+  def end(self,timeout=30):
+    self.stopping = True
+    while len(self.workers)>0: self.__retire()
+    deadline = time.time() + timeout
+    for p in self.draining:
+      p.join(max(0,deadline-time.time()))
+      if p.is_alive():
+        print(colored('Consumer #{0} did not drain in time, killed'.format(p.pid),'red'))
+        p.kill()
+        p.join()
 
 def on_signal(signal,frame):
-  global workers
   print(colored('--------------------------','yellow'))
   print(colored(' Signaled to terminate...','yellow'))
   print(colored('--------------------------','yellow'))
 
   # End all background services
-  for sp in workers:
-    subprocess.Popen(
-      'kill {0}'.format(sp.pid),
-      shell=True, 
-      stdout=subprocess.PIPE
-    ) 
-
-  # Keep waiting until all subprocess were killed
+  # and keep waiting until they were killed
   print('Waiting for services to end...')
-  [sp.wait() for sp in workers]
+  if pool is not None: pool.end()
+  if tokenisers is not None: tokenisers.end()
 
   sys.exit(0)
 
 if __name__ == '__main__':
+  args = vars(arguments.parse_known_args(sys.argv[1:])[0])
 
   # Startup message
   print(colored('--------------------------','cyan'))
@@ -110,20 +231,26 @@ if __name__ == '__main__':
 
   # Load classification models
   # and make a classifer function
-  (topicHasher,taghasher,contentClf,clf) = textprocess.load_models()
-  classify = textprocess.classify_text(topicHasher,taghasher,contentClf,clf)
-
-  # Start the monitoring process
-  mqinput = rabbit.create('localhost',MQ_INPUT)
-
-  # Execute all background services
-  workers = execute_background_services()
+  (topicHasher,tagHasher,clf) = textprocess.load_models()
+  classify = textprocess.classify_text(topicHasher,tagHasher,clf)
 
+  # Execute the pool of tokenisers in background
+  # (TOKENIZER_WORKERS sets the number of workers)
+  tokenisers = tokenpool.start()
 
   # Await ...
   signal.signal(signal.SIGINT, on_signal)
+  signal.signal(signal.SIGTERM, on_signal)
 
+  # Start the monitoring process
+  mqinput  = rabbit.create('localhost',MQ_INPUT)
 
   print(colored("Monitoring process begins...","cyan"))
-  rabbit.listen(mqinput,on_phone_ring)
-  ##signal.pause()
+  if args['workers']>0 or args['autoscale']:
+    # Consumers are forked once the models are loaded
+    pool = MonitorPool(args['workers'] or 1,args['batch'],args['linger']/1000,
+      args['autoscale'],args['min_workers'],args['max_workers'],args['backlog'])
+    pool.run(mqinput)
+  else:
+    mqoutput = rabbit.create('localhost',MQ_OUTPUT)
+    monitor(mqinput,mqoutput,args['batch'],args['linger']/1000)
@@ -10,68 +10,52 @@ to train the classificier(s).
 
 from pydb import couch
 from pprint import pprint
-from queue import Queue
 from termcolor import colored
 from collections import deque
 from pypipe import pipe as Pipe
+from pypipe import metrics
+from pypipe import profiling
 from pypipe.operations import preprocess
 from pypipe.operations import wordbag
 from pypipe.operations import rabbit
-import subprocess
-import signal
+from pypipe.operations import seglog
+from pypipe.operations import tokenpool
+import argparse
 import json
-import time
+import sys
 import os
 
 REPO_DIR = os.getenv('PANTIPLIBR','.')
 WORD_BAG_DIR = '{0}/data/words/freq.txt'.format(REPO_DIR)
-
-# DEPRECATED:
-def execute_background_services(commands):
-  workers = []
-  for cmd in commands:
-    print(colored('🚀 Executing...','green') + cmd)
-    sp = subprocess.Popen(cmd, 
-      shell=True, stdout=subprocess.PIPE,
-      preexec_fn=os.setsid)
-    workers.append(sp)
-  return workers
-
-def terminate_background_services(workers):
-  print(colored('Waiting for background services...','green'))
-  q = Queue(maxsize=1)
-
-  # DEPRECATED:
-  def __timeout(signum,frame):
-    signal.alarm(0) # Cancel further timeout
-    print(colored('Ending background services...','green'))
-    for p in workers:
-      subprocess.Popen('kill {0}'.format(p.pid), 
-        shell=True, stdout=subprocess.PIPE)
-    # All done, unlock the queue
-    q.task_done()
-
-  # Terminate the first subprocess (ruby server)
-  subprocess.Popen('kill {0}'.format(workers[0].pid),
-    shell=True, stdout=subprocess.PIPE)
-
-
-  # Wait for the rest
-  wait_list  = workers[1:]
-  if len(wait_list)==0: return
-
-  pids       = [str(p.pid) for p in wait_list]
-  print('waiting for : {0}'.format(','.join(pids)))
-  exit_codes = [subp.wait() for subp in wait_list]
-
-
-  print(colored('All subprocesses finished! Bye','green'))
-
-  # signal.signal(signal.SIGALRM,__timeout)
-  # signal.alarm(10) # seconds
-  # q.put('wait')
-  # q.join() # Block until it timeouts
-  # q.get()
+SINCE_PATH = '{0}/data/changes-since.json'.format(REPO_DIR)
+TOKEN_CACHE_PATH = '{0}/data/tokencache'.format(REPO_DIR)
+SEGMENT_LOG_DIR = '{0}/data/seglog'.format(REPO_DIR)
+
+# Only these fields of the records are needed downstream
+FIELDS = ['title','topic','tags','vote','emoti']
+
+# Prepare processing arguments
+arguments = argparse.ArgumentParser()
+arguments.add_argument('--limit', type=int, default=40000) # Number of records to process (full run)
+arguments.add_argument('--incremental', dest='incremental', action='store_true') # Only process the changes since the last run
+arguments.add_argument('--follow', dest='follow', action='store_true') # Keep following the changes feed
+arguments.add_argument('--checkpoint', type=int, default=100) # Save the changes sequence every N records
+arguments.add_argument('--tokenizers', type=int, default=None) # Number of tokeniser workers (default: number of cores)
+arguments.add_argument('--tokencache', type=str, default=TOKEN_CACHE_PATH) # On-disk tokenisation cache ('' to disable)
+arguments.add_argument('--chunk', type=int, default=0) # Process the records in chunks of N (0 = one by one)
+arguments.add_argument('--linger', type=float, default=2.0) # Longest wait for a chunk of followed changes to fill up (seconds)
+arguments.add_argument('--workers', type=int, default=0) # Process the records over N processes (full run)
+arguments.add_argument('--inflight', type=int, default=0) # Process up to N records concurrently (full run)
+arguments.add_argument('--unordered', dest='unordered', action='store_true') # Parallel outputs need not keep the input order
+arguments.add_argument('--publish-batch', dest='publish_batch', type=int, default=200) # Messages buffered before publishing to the MQs
+arguments.add_argument('--confirm', dest='confirm', action='store_true') # Wait for the broker to confirm each published message (publisher confirms)
+arguments.add_argument('--transport', type=str, default='mq') # Write the records to the [mq] or to the segment [log]
+arguments.add_argument('--log-dir', dest='log_dir', type=str, default=SEGMENT_LOG_DIR) # Directory of the segment logs
+arguments.add_argument('--metrics', dest='metrics', action='store_true') # Report per-stage throughput & latency
+arguments.add_argument('--metrics-every', dest='metrics_every', type=int, default=None) # Print the stage metrics every N seconds
+arguments.add_argument('--metrics-dump', dest='metrics_dump', type=str, default=None) # Write the stage metrics to a JSON file
+arguments.add_argument('--profile', type=str, default=None) # Write the stage profiles into this directory
+arguments.add_argument('--profile-mode', dest='profile_mode', type=str, default='cprofile') # [cprofile] or [sample]
 
 def print_record(rec):
   print(rec['tags'])
@@ -81,51 +65,131 @@ def process_with(pipe):
   def f(input0):
     Pipe.operate(pipe,input0)
   return f
-  
+
+# Process only the new or updated records
+# from the CouchDB changes feed
+# @param {Function} flush, sends out the buffered outputs (e.g. the MQ feed)
+#                   so the checkpoint never runs ahead of them
+# @param {float} linger, longest wait for a chunk of followed changes to fill up
+def process_changes(db,pipe,follow=False,checkpoint=100,chunk=0,flush=None,linger=2.0):
+  since = couch.load_since(SINCE_PATH)
+  print(colored('Processing changes since #{0}'.format(since),'green'))
+  n,seq = 0,since
+
+  def save(seq):
+    if flush is not None: flush()
+    couch.save_since(SINCE_PATH,seq)
+
+  try:
+    if chunk>0:
+      # The checkpoint is saved after each completed chunk,
+      # a followed feed never holds a chunk back over [linger]
+      changes = couch.changes(db,since=since,follow=follow)
+      for batch in Pipe.chunks(changes,chunk,linger if follow else None):
+        Pipe.operate_chunk(pipe,[record for _,record in batch])
+        seq = batch[-1][0]
+        n  += len(batch)
+        save(seq)
+    else:
+      for seq,record in couch.changes(db,since=since,follow=follow):
+        Pipe.operate(pipe,record)
+        n += 1
+        if n%checkpoint==0: save(seq)
+  except KeyboardInterrupt:
+    print(colored('Stopped following the changes','yellow'))
+  save(seq)
+  print(colored('{0} changed records processed'.format(n),'green'))
+
 
 if __name__ == '__main__':
+  args = vars(arguments.parse_args(sys.argv[1:]))
+
   # Prepare the database server connection
   db = couch.connector('pantip')
 
+  if args['metrics'] or args['metrics_every'] or args['metrics_dump']:
+    metrics.enable(args['metrics_every'],args['metrics_dump'])
+  if args['profile']:
+    profiling.enable(args['profile'],args['profile_mode'])
+
   # Prepare word bag
   bag = wordbag.new()
 
-  # Execute list of required background services
-  services = [
-    'ruby {0}/core/tokenizer/tokenizer.rb'.format(REPO_DIR),
-    ##'python3 {0}/core/textprocess.py'.format(REPO_DIR)
-    ]
-  workers  = execute_background_services(services)
-
-  # Delayed start
-  time.sleep(1)
-
-  # These are MQs we'll push preprocessed records to
-  qs = ['pantip-x1','pantip-x2','pantip-x3','pantip-x0']
-  mqs = [rabbit.create('localhost',q) for q in qs]
+  # Tokenised texts from the previous runs
+  if args['tokencache']:
+    preprocess.use_cache(path=args['tokencache'])
+
+  # Execute the pool of tokenisers in background
+  # (waits until all of them are ready)
+  tokenisers = tokenpool.start(args['tokenizers'])
+
+  incremental = args['incremental'] or args['follow']
+  if args['transport']=='log':
+    # One replayable log serves all the training steps,
+    # a full run writes it over
+    relay = seglog
+    mqs = [seglog.create(args['log_dir'],'pantip-x')]
+    if not incremental: seglog.purge(mqs[0])
+  else:
+    # These are MQs we'll push preprocessed records to,
+    # the exchange delivers each record to all of them
+    relay = rabbit
+    qs = ['pantip-x1','pantip-x2','pantip-x3','pantip-x0']
+    mqs = [rabbit.create_exchange('localhost','pantip-x',qs)]
 
   # Prepare the processing pipeline (order matters)
   pipe = Pipe.new('preprocess',[])
   Pipe.push(pipe,preprocess.take)
-  Pipe.push(pipe,rabbit.feed(mqs))
+  # A followed record is published right away rather
+  # than waiting for the batch to fill up
+  feed = relay.feed(mqs,0 if args['follow'] else args['publish_batch'],args['confirm'])
+  Pipe.push(pipe,feed)
   Pipe.push(pipe,wordbag.feed(bag))
-  Pipe.then(pipe,lambda out: print(colored('[DONE!]','cyan')))
+  if args['chunk']>0 or args['workers']>0:
+    Pipe.then(pipe,lambda out: print(colored('[DONE!] {0} records'.format(len(out)),'cyan')))
+  else:
+    Pipe.then(pipe,lambda out: print(colored('[DONE!]','cyan')))
 
   # Iterate through each record and processing
-  couch.each_do(db,process_with(pipe),limit=40000)
+  if incremental:
+    process_changes(db,pipe,args['follow'],args['checkpoint'],args['chunk'],feed.flush,args['linger'])
+  else:
+    # The next incremental run starts from here
+    since = db.info()['update_seq']
+    if args['inflight']>0:
+      records = couch.iter(db,limit=args['limit'],fields=FIELDS)
+      Pipe.operate_concurrent(pipe,records,args['inflight'])
+    elif args['workers']>0:
+      records = couch.iter(db,limit=args['limit'],fields=FIELDS)
+      Pipe.operate_parallel(pipe,records,args['workers'],
+        ordered=not args['unordered'],chunk_size=args['chunk'] or 100)
+    elif args['chunk']>0:
+      records = couch.iter(db,limit=args['limit'],fields=FIELDS)
+      Pipe.operate_batch(pipe,records,args['chunk'])
+    else:
+      couch.each_do(db,process_with(pipe),limit=args['limit'],fields=FIELDS)
+    feed.flush()
+    couch.save_since(SINCE_PATH,since)
 
   # Disconnect from the MQs
-  [rabbit.end(mq) for mq in mqs]
+  [relay.end(mq) for mq in mqs]
+
+  metrics.report()
+
+  print(colored('[Tokenisation cache]','green'))
+  pprint(preprocess.cache.stats())
+  preprocess.cache.close()
 
-  # Waiting for the background services
-  # and kill `em
-  terminate_background_services(workers)
+  # Kill the tokenisers
+  tokenisers.end()
 
   # Report the collected word bag
   print(colored('[Word bag]','green'))
   words = sorted(bag.items(),key=lambda b: -b[1])[:50]
   pprint(words)
   # Print most recurring words to file
-  with open(WORD_BAG_DIR,'w+') as txt:
-    txt.writelines([w[0] + "\n" for w in words])
+  # (only a full run sees the entire corpus)
+  if not incremental:
+    with open(WORD_BAG_DIR,'w+') as txt:
+      txt.writelines([w[0] + "\n" for w in words])
 
@@ -4,6 +4,13 @@ CouchDB connector for Pantip-libr
 """
 
 from couchdb.client import Server
+from couchdb.http import HTTPError
+from termcolor import colored
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import atexit
+import json
+import os
 
 def connector(collection):
   # Make a server connection
@@ -17,17 +24,199 @@ def push(db,record):
   _id, _rev = db.save(record)
   return (_id,_rev)
 
+# Buffered writer which saves the records in bulk
+# through `_bulk_docs`. The buffer is flushed whenever
+# it holds [max_docs] records, [max_wait] seconds after
+# its first record arrives, and on shutdown.
+# A record only counts as stored once [on_stored] is called
+# for it; a failed request fails all the records it carried.
+class BulkWriter(object):
+  def __init__(self,db,max_docs=500,max_wait=5.0,on_failed=None,on_stored=None):
+    self.db        = db
+    self.max_docs  = max_docs
+    self.max_wait  = max_wait
+    self.on_failed = on_failed # Callback of (record, exception)
+    self.on_stored = on_stored # Callback of (record, rev)
+    self.buffer    = []
+    self.timer     = None
+    self.lock      = threading.RLock()
+    self.stored    = 0
+    self.conflicts = [] # List of (doc id, exception)
+    self.failures  = 0 # Records lost to failed requests
+    atexit.register(self.close)
+
+  def push(self,record):
+    with self.lock:
+      self.buffer.append(record)
+      if len(self.buffer)>=self.max_docs:
+        self.flush()
+      elif self.timer is None and self.max_wait:
+        self.timer = threading.Timer(self.max_wait,self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+  # Save all buffered records in a single request
+  # @return {list} of (success, docid, rev_or_exc)
+  def flush(self):
+    with self.lock:
+      if self.timer is not None:
+        self.timer.cancel()
+        self.timer = None
+      if len(self.buffer)==0: return []
+      docs,self.buffer = self.buffer,[]
+
+      try:
+        results = self.db.update(docs)
+      except Exception as e:
+        # Also raised in the timer thread, where nobody would see it
+        print(colored('BULK SAVE FAILED ({0} records) : {1}'.format(len(docs),e),'red'))
+        results = [(False,doc.get('_id'),e) for doc in docs]
+        self.failures += len(docs)
+        if self.on_failed:
+          for doc in docs: self.on_failed(doc,e)
+        return results
+
+      for doc,(success,_id,rev_or_exc) in zip(docs,results):
+        if success:
+          self.stored += 1
+          if self.on_stored: self.on_stored(doc,rev_or_exc)
+          continue
+        print(colored('CONFLICT #{0} : {1}'.format(_id,rev_or_exc),'red'))
+        self.conflicts.append((_id,rev_or_exc))
+        if self.on_failed: self.on_failed(doc,rev_or_exc)
+      return results
+
+  def close(self):
+    self.flush()
+    atexit.unregister(self.close)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*exc):
+    self.close()
+
 # Apply functions on to the database
+# @param {int} limit (optional) number of records to process
+# @param {int} page_size (optional) number of records fetched per request
+# @param {list} fields (optional) projection of the fields to fetch
 def each_do(db,func,**kwargs):
-  n = 1
-  for _id in db:
-    func(db.get(_id))
+  n = 0
+  for doc in stream(db,**kwargs):
+    func(doc)
     n+=1
-    if 'limit' in kwargs and n>kwargs['limit']:
-      print('Limit of {0} records reached.'.format(kwargs['limit']))
-      break
+  if 'limit' in kwargs and n>=kwargs['limit']:
+    print('Limit of {0} records reached.'.format(kwargs['limit']))
 
 def iter(db,**kwargs):
-  for _id in db:
-    yield db.get(_id)
-    
\ No newline at end of file
+  return stream(db,**kwargs)
+
+# Stream the records page by page, the next page
+# is fetched in background while the current one is consumed
+# @param {int} number of records fetched per request
+# @param {list} projection of the fields to fetch (via Mango `_find`,
+#               or over the view on servers without it, before 2.1)
+# @param {int} maximum number of records to take
+# @param {str} name of the view to page through (`include_docs`)
+def stream(db,page_size=1000,fields=None,limit=None,view='_all_docs',prefetch=True):
+  if limit is not None: page_size = max(1,min(page_size,limit))
+
+  if fields: pages = __find_pages(db,page_size,fields)
+  else: pages = __view_pages(db,page_size,view)
+  if prefetch: pages = __prefetch(pages)
+
+  n = 0
+  for page in pages:
+    for doc in page:
+      if limit is not None and n>=limit: return
+      yield doc
+      n += 1
+
+def __view_pages(db,page_size,view):
+  opts = {'include_docs': True, 'limit': page_size}
+  while True:
+    rows = list(db.view(view,**opts))
+    if len(rows)==0: return
+    yield [r.doc for r in rows if not r.id.startswith('_design/')]
+    if len(rows)<page_size: return
+
+    # Continue right after the last row of this page
+    opts.update(startkey=rows[-1].key,startkey_docid=rows[-1].id,skip=1)
+
+def __find_pages(db,page_size,fields):
+  query = {
+    'selector': {'_id': {'$gt': None}},
+    'fields': fields,
+    'limit': page_size
+  }
+  try:
+    _,_,data = db.resource.post_json('_find',body=query)
+  except HTTPError as e:
+    # No Mango on the server (CouchDB 1.x)
+    print(colored('_find unavailable ({0}), paging through _all_docs'.format(e),'yellow'))
+    yield from __project(__view_pages(db,page_size,'_all_docs'),fields)
+    return
+  if len(data['docs'])>=page_size and 'bookmark' not in data:
+    # No bookmarks to page with (CouchDB 2.0)
+    print(colored('_find without bookmarks, paging through _all_docs','yellow'))
+    yield from __project(__view_pages(db,page_size,'_all_docs'),fields)
+    return
+
+  while True:
+    docs = data['docs']
+    if len(docs)==0: return
+    yield docs
+    if len(docs)<page_size or 'bookmark' not in data: return
+    query['bookmark'] = data['bookmark']
+    _,_,data = db.resource.post_json('_find',body=query)
+
+# Keep only the [fields] of the docs, as `_find` does
+def __project(pages,fields):
+  for page in pages:
+    yield [{f: doc[f] for f in fields if f in doc} for doc in page]
+
+def __prefetch(pages):
+  with ThreadPoolExecutor(max_workers=1) as worker:
+    future = worker.submit(next,pages,None)
+    while True:
+      page = future.result()
+      if page is None: return
+      future = worker.submit(next,pages,None)
+      yield page
+
+# Stream the records created or updated after the [since]
+# sequence, through the `_changes` feed
+# @param {str|int} sequence to start after (0 for the beginning)
+# @param {bool} follow the feed continuously for further changes
+# @param {int} number of changes fetched per request (normal feed)
+# @return {generator} of (seq, record)
+def changes(db,since=0,follow=False,batch=500,heartbeat=30000):
+  if follow:
+    feed = db.changes(feed='continuous',since=since,
+      include_docs=True,heartbeat=heartbeat)
+  else:
+    feed = __change_pages(db,since,batch)
+
+  for change in feed:
+    if 'id' not in change: continue # Trailing [last_seq] notice
+    if change.get('deleted') or change['id'].startswith('_design/'): continue
+    yield (change['seq'],change['doc'])
+
+def __change_pages(db,since,batch):
+  while True:
+    page = db.changes(since=since,limit=batch,include_docs=True)
+    for change in page['results']: yield change
+    if len(page['results'])<batch: return
+    since = page['last_seq']
+
+# Load the last processed sequence of the changes feed
+def load_since(path):
+  if not os.path.isfile(path): return 0
+  with open(path) as f:
+    return json.load(f)['since']
+
+def save_since(path,since):
+  tmp = path + '.tmp'
+  with open(tmp,'w') as f:
+    json.dump({'since': since},f)
+  os.replace(tmp,path)
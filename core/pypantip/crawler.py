@@ -0,0 +1,233 @@
+"""
+Concurrent Pantip crawler
+---------------------------
+Download, parse and store the topics in the specified
+range concurrently. Downloads go through a pool of
+keep-alive HTTP connections with bounded in-flight requests,
+parsing and storing are fed through bounded queues
+so each stage works on its own pace.
+
+@starcolon projects
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from urllib.parse import urlsplit, urljoin
+from urllib.request import urlopen
+from termcolor import colored
+from . import scraper
+import http.client
+import asyncio
+import queue
+import time
+
+# Pool of persistent (keep-alive) HTTP connections
+# to a single origin. Safe to share among threads.
+class ConnectionPool(object):
+  def __init__(self,base_url,size=8,timeout=30):
+    origin       = urlsplit(base_url)
+    self.scheme  = origin.scheme
+    self.host    = origin.netloc
+    self.size    = size
+    self.timeout = timeout
+    self.idle    = queue.LifoQueue(maxsize=size)
+
+  def __connect(self):
+    if self.scheme=='https':
+      return http.client.HTTPSConnection(self.host,timeout=self.timeout)
+    else:
+      return http.client.HTTPConnection(self.host,timeout=self.timeout)
+
+  def __acquire(self):
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      return self.__connect()
+
+  def __release(self,conn):
+    try:
+      self.idle.put_nowait(conn)
+    except queue.Full:
+      conn.close()
+
+  # Make a GET request over one of the pooled connections
+  # @return {tuple} of (status, location, body bytes)
+  def request(self,path):
+    conn = self.__acquire()
+    try:
+      try:
+        conn.request('GET',path,headers={'Connection':'keep-alive'})
+        resp = conn.getresponse()
+      except (http.client.HTTPException,OSError):
+        # The idle connection might have been dropped
+        # by the server, retry once over a fresh one
+        conn.close()
+        conn = self.__connect()
+        conn.request('GET',path,headers={'Connection':'keep-alive'})
+        resp = conn.getresponse()
+      body = resp.read()
+    except Exception:
+      conn.close()
+      raise
+
+    if resp.will_close: conn.close()
+    else: self.__release(conn)
+    return (resp.status,resp.getheader('Location'),body)
+
+  # Download the page, following the redirections
+  # @return {str} html
+  def get(self,url,max_redirect=3):
+    for _ in range(max_redirect+1):
+      target = urlsplit(url)
+      if target.netloc!=self.host or target.scheme!=self.scheme:
+        # Off-origin redirection, not worth pooling
+        with urlopen(url,timeout=self.timeout) as resp:
+          return resp.read().decode('utf-8')
+
+      path = target.path + ('?' + target.query if target.query else '')
+      status,location,body = self.request(path or '/')
+      if status in (301,302,303,307,308) and location:
+        url = urljoin(url,location)
+        continue
+      if status!=200:
+        raise IOError('HTTP {0} : {1}'.format(status,url))
+      return body.decode('utf-8')
+
+    raise IOError('Too many redirections : {0}'.format(url))
+
+  def close(self):
+    while True:
+      try:
+        self.idle.get_nowait().close()
+      except queue.Empty:
+        break
+
+
+# Crawl the topics and push each of the scraped records
+# to the storage function
+# @param {iterable} of topic ids
+# @param {Function} storage function which takes a scraped record
+# @param {int} maximum number of in-flight downloads
+# @param {int} number of parser processes (0 parses in a thread)
+# @param {ledger.Ledger} crawl ledger to skip finished ids and record progress (optional)
+# @param {str} extraction engine, [dom] or [stream]
+# @param {htmlcache.HtmlCache} cache of the raw pages (optional)
+# @param {bool} read the pages from the cache instead of the network
+# @param {bool} the storage function only buffers the records (e.g. couch.BulkWriter),
+#               it then marks them stored in the ledger itself once they are saved
+# @return {dict} summary of the crawl
+def crawl(topic_ids,store,concurrency=16,parsers=0,base_url=None,ledger=None,engine=None,
+  cache=None,replay=False,buffered=False):
+  loop = asyncio.new_event_loop()
+  try:
+    return loop.run_until_complete(
+      crawl_async(topic_ids,store,concurrency,parsers,base_url,ledger,engine,cache,replay,buffered))
+  finally:
+    loop.close()
+
+async def crawl_async(topic_ids,store,concurrency=16,parsers=0,base_url=None,ledger=None,engine=None,
+  cache=None,replay=False,buffered=False):
+  base_url = base_url or scraper.PANTIP_URL
+  engine   = engine or scraper.ENGINE
+  loop     = asyncio.get_event_loop()
+  pool     = ConnectionPool(base_url,size=concurrency)
+  summary  = {'stored': 0, 'deleted': 0, 'failed': 0}
+
+  # Each stage owns its executor so a slow stage
+  # never starves the others of threads
+  downloader = ThreadPoolExecutor(max_workers=concurrency)
+  parser     = ProcessPoolExecutor(max_workers=parsers) if parsers>0 \
+               else ThreadPoolExecutor(max_workers=1)
+  storer     = ThreadPoolExecutor(max_workers=1)
+
+  # Bounded queues between the stages (backpressure)
+  todo  = asyncio.Queue(maxsize=concurrency*2)
+  pages = asyncio.Queue(maxsize=concurrency*2)
+  docs  = asyncio.Queue(maxsize=concurrency*2)
+  n_parsers = max(parsers,1)
+
+  def download(topic_id):
+    if replay:
+      html = cache.get(topic_id)
+      if html is None: raise KeyError('not cached')
+      return html
+
+    url  = base_url.rstrip('/') + '/topic/{0}'.format(topic_id)
+    html = pool.get(url)
+    if cache is not None: cache.put(topic_id,html)
+    return html
+
+  if ledger is not None:
+    topic_ids = ledger.pending(topic_ids)
+
+  def fail(topic_id):
+    summary['failed'] += 1
+    if ledger is not None: ledger.mark_failed(topic_id)
+
+  async def produce():
+    for topic_id in topic_ids:
+      await todo.put(topic_id)
+    for _ in range(concurrency):
+      await todo.put(None)
+
+  async def fetch():
+    while True:
+      topic_id = await todo.get()
+      if topic_id is None: break
+      try:
+        html = await loop.run_in_executor(downloader,download,topic_id)
+      except Exception as e:
+        print(colored('FAILED #{0} : {1}'.format(topic_id,e),'red'))
+        fail(topic_id)
+        continue
+      await pages.put((topic_id,html))
+
+  async def parse():
+    while True:
+      page = await pages.get()
+      if page is None: break
+      topic_id,html = page
+      try:
+        doc = await loop.run_in_executor(parser,scraper.scrape_html,topic_id,html,engine)
+      except Exception as e:
+        print(colored('UNPARSABLE #{0} : {1}'.format(topic_id,e),'red'))
+        fail(topic_id)
+        continue
+      if doc is None:
+        summary['deleted'] += 1
+        if ledger is not None: ledger.mark_deleted(topic_id)
+        continue
+      await docs.put(doc)
+
+  async def save():
+    while True:
+      doc = await docs.get()
+      if doc is None: break
+      try:
+        await loop.run_in_executor(storer,store,doc)
+        summary['stored'] += 1
+        if ledger is not None and not buffered: ledger.mark_stored(doc['topic_id'])
+      except Exception as e:
+        print(colored('UNSTORED #{0} : {1}'.format(doc['topic_id'],e),'red'))
+        fail(doc['topic_id'])
+
+  t0 = time.time()
+  try:
+    fetchers = [asyncio.ensure_future(fetch()) for _ in range(concurrency)]
+    parsing  = [asyncio.ensure_future(parse()) for _ in range(n_parsers)]
+    saving   = asyncio.ensure_future(save())
+
+    await produce()
+    await asyncio.gather(*fetchers)
+    for _ in range(n_parsers): await pages.put(None)
+    await asyncio.gather(*parsing)
+    await docs.put(None)
+    await saving
+  finally:
+    downloader.shutdown()
+    parser.shutdown()
+    storer.shutdown()
+    pool.close()
+    if ledger is not None: ledger.save()
+
+  summary['elapsed'] = time.time() - t0
+  return summary
@@ -0,0 +1,139 @@
+"""
+Raw HTML cache
+---------------------------
+Content-addressed on-disk store of the fetched pages.
+Each page is gzipped and saved once under the SHA-1 of
+its content, an append-only index maps (topic id, fetch time)
+to the content. The oldest fetches are evicted once
+the cache grows beyond its size limit.
+
+  <path>/index.jsonl
+  <path>/objects/ab/abcdef0123....html.gz
+
+@starcolon projects
+"""
+
+from termcolor import colored
+import threading
+import hashlib
+import json
+import gzip
+import time
+import os
+
+_1GB = 1073741824
+
+class HtmlCache(object):
+  def __init__(self,path,max_bytes=8*_1GB):
+    self.path      = path
+    self.max_bytes = max_bytes
+    self.lock      = threading.Lock()
+    self.entries   = {} # topic id => [(fetched_at, sha1)] oldest first
+    self.sizes     = {} # sha1 => compressed size
+    self.refs      = {} # sha1 => number of entries referring to it
+    self.total     = 0
+    os.makedirs(os.path.join(path,'objects'),exist_ok=True)
+    self.__load_index()
+
+  def __index_path(self):
+    return os.path.join(self.path,'index.jsonl')
+
+  def __blob_path(self,sha1):
+    return os.path.join(self.path,'objects',sha1[:2],sha1 + '.html.gz')
+
+  def __load_index(self):
+    if not os.path.isfile(self.__index_path()): return
+    with open(self.__index_path()) as f:
+      for line in f:
+        try:
+          e = json.loads(line)
+        except ValueError:
+          continue # Partially written line
+        self.__add_entry(e['topic_id'],e['fetched_at'],e['sha1'],e['size'])
+
+  def __add_entry(self,topic_id,fetched_at,sha1,size):
+    self.entries.setdefault(topic_id,[]).append((fetched_at,sha1))
+    if sha1 not in self.refs:
+      self.refs[sha1]  = 0
+      self.sizes[sha1] = size
+      self.total      += size
+    self.refs[sha1] += 1
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __contains__(self,topic_id):
+    return topic_id in self.entries
+
+  def topics(self):
+    return sorted(self.entries)
+
+  # Store the downloaded page
+  # @return {str} content hash of the page
+  def put(self,topic_id,html,fetched_at=None):
+    fetched_at = fetched_at or time.time()
+    data = html.encode('utf-8')
+    sha1 = hashlib.sha1(data).hexdigest()
+
+    with self.lock:
+      blob = self.__blob_path(sha1)
+      if sha1 in self.sizes:
+        size = self.sizes[sha1] # Identical page already stored
+      else:
+        os.makedirs(os.path.dirname(blob),exist_ok=True)
+        with gzip.open(blob + '.tmp','wb') as f:
+          f.write(data)
+        os.replace(blob + '.tmp',blob)
+        size = os.path.getsize(blob)
+
+      with open(self.__index_path(),'a') as f:
+        f.write(json.dumps({
+          'topic_id': topic_id,
+          'fetched_at': fetched_at,
+          'sha1': sha1,
+          'size': size
+        }) + '\n')
+      self.__add_entry(topic_id,fetched_at,sha1,size)
+
+      if self.total>self.max_bytes: self.__evict()
+    return sha1
+
+  # Read the latest page of the topic fetched at or before [at]
+  # @return {str} html or None if the topic is not cached
+  def get(self,topic_id,at=None):
+    with self.lock:
+      fetches = [sha1 for t,sha1 in self.entries.get(topic_id,[])
+                 if at is None or t<=at]
+    if len(fetches)==0: return None
+    with gzip.open(self.__blob_path(fetches[-1]),'rb') as f:
+      return f.read().decode('utf-8')
+
+  # Drop the oldest fetches until the cache fits its limit,
+  # then rewrite the index without them
+  def __evict(self):
+    fetches = sorted((t,topic_id) for topic_id,es in self.entries.items() for t,_ in es)
+    target  = self.max_bytes * 0.9
+    n = 0
+    for t,topic_id in fetches:
+      if self.total<=target: break
+      _,sha1 = self.entries[topic_id].pop(0)
+      if len(self.entries[topic_id])==0: del self.entries[topic_id]
+      self.refs[sha1] -= 1
+      if self.refs[sha1]==0:
+        os.remove(self.__blob_path(sha1))
+        self.total -= self.sizes.pop(sha1)
+        del self.refs[sha1]
+      n += 1
+
+    tmp = self.__index_path() + '.tmp'
+    with open(tmp,'w') as f:
+      for topic_id,es in self.entries.items():
+        for t,sha1 in es:
+          f.write(json.dumps({
+            'topic_id': topic_id,
+            'fetched_at': t,
+            'sha1': sha1,
+            'size': self.sizes[sha1]
+          }) + '\n')
+    os.replace(tmp,self.__index_path())
+    print(colored('HTML cache evicted {0} pages'.format(n),'yellow'))
@@ -0,0 +1,142 @@
+"""
+Crawl ledger
+---------------------------
+Persistent record of the topic ids already stored,
+known to be deleted, or failed to fetch. Ids are kept
+as run-length sets over the id space so a range of
+millions of ids costs only a handful of intervals.
+
+@starcolon projects
+"""
+
+from termcolor import colored
+import threading
+import bisect
+import json
+import os
+
+# Set of integers stored as sorted, disjoint,
+# half-open intervals [start, end)
+class RangeSet(object):
+  def __init__(self,intervals=[]):
+    self.starts = []
+    self.ends   = []
+    for a,b in intervals: self.add_range(a,b)
+
+  def __contains__(self,n):
+    i = bisect.bisect_right(self.starts,n) - 1
+    return i>=0 and n<self.ends[i]
+
+  def __len__(self):
+    return sum(b-a for a,b in zip(self.starts,self.ends))
+
+  def __iter__(self):
+    for a,b in zip(self.starts,self.ends):
+      yield from range(a,b)
+
+  def add(self,n):
+    self.add_range(n,n+1)
+
+  def add_range(self,a,b):
+    if a>=b: return
+    # Locate all intervals touching [a,b) and merge them
+    i = bisect.bisect_left(self.ends,a)
+    j = bisect.bisect_right(self.starts,b)
+    if i<j:
+      a = min(a,self.starts[i])
+      b = max(b,self.ends[j-1])
+    self.starts[i:j] = [a]
+    self.ends[i:j]   = [b]
+
+  def discard(self,n):
+    i = bisect.bisect_right(self.starts,n) - 1
+    if i<0 or n>=self.ends[i]: return
+    a,b = self.starts[i],self.ends[i]
+    pieces = [(x,y) for x,y in [(a,n),(n+1,b)] if x<y]
+    self.starts[i:i+1] = [x for x,y in pieces]
+    self.ends[i:i+1]   = [y for x,y in pieces]
+
+  def intervals(self):
+    return [[a,b] for a,b in zip(self.starts,self.ends)]
+
+
+class Ledger(object):
+  def __init__(self,path,checkpoint_every=100):
+    self.path    = path
+    self.every   = checkpoint_every
+    self.dirty   = 0
+    self.lock    = threading.Lock()
+    self.stored  = RangeSet()
+    self.deleted = RangeSet()
+    self.failed  = RangeSet()
+
+  # Whether the topic needs no further fetching
+  def is_done(self,topic_id):
+    return topic_id in self.stored or topic_id in self.deleted
+
+  # Filter out the finished ids out of the range
+  def pending(self,topic_ids):
+    return (i for i in topic_ids if not self.is_done(i))
+
+  def mark_stored(self,topic_id):
+    self.__mark(self.stored,topic_id)
+
+  def mark_deleted(self,topic_id):
+    self.__mark(self.deleted,topic_id)
+
+  # NOTE: A topic may fail after being handed to a
+  # buffered writer, the latest outcome always wins
+  def mark_failed(self,topic_id):
+    with self.lock:
+      self.failed.add(topic_id)
+      self.stored.discard(topic_id)
+      self.__touch()
+
+  def __mark(self,rangeset,topic_id):
+    with self.lock:
+      rangeset.add(topic_id)
+      self.failed.discard(topic_id)
+      self.__touch()
+
+  def __touch(self):
+    self.dirty += 1
+    if self.dirty>=self.every:
+      self.__save()
+
+  def summary(self):
+    return {
+      'stored':  len(self.stored),
+      'deleted': len(self.deleted),
+      'failed':  len(self.failed)
+    }
+
+  def save(self):
+    with self.lock:
+      self.__save()
+
+  def __save(self):
+    # Write to a temporary file first so a crash
+    # never leaves a half-written ledger behind
+    tmp = self.path + '.tmp'
+    with open(tmp,'w') as f:
+      json.dump({
+        'stored':  self.stored.intervals(),
+        'deleted': self.deleted.intervals(),
+        'failed':  self.failed.intervals()
+      },f)
+    os.replace(tmp,self.path)
+    self.dirty = 0
+
+
+# Load the ledger from the physical file,
+# or initialise a new one if the file doesn't exist
+def safe_load(path,checkpoint_every=100):
+  ledger = Ledger(path,checkpoint_every)
+  if os.path.isfile(path):
+    with open(path) as f:
+      data = json.load(f)
+    ledger.stored  = RangeSet(data.get('stored',[]))
+    ledger.deleted = RangeSet(data.get('deleted',[]))
+    ledger.failed  = RangeSet(data.get('failed',[]))
+    print(colored('Crawl ledger loaded : ','green'), ledger.summary())
+  return ledger
@@ -5,13 +5,58 @@ Pantip Scraper
 
 from htmldom import htmldom
 from termcolor import colored
+from collections import Counter
+from urllib.request import urlopen
+import os
+import re
 
-def scrape(topic_id):
-  # Download the topic and create DOM over it
-  url  = 'http://www.pantip.com/topic/{0}'.format(topic_id)
+PANTIP_URL = os.getenv('PANTIP_URL','http://www.pantip.com')
+ENGINE     = os.getenv('PANTIP_SCRAPER','dom') # [dom] or [stream]
+
+__emotions = ['ขำกลิ้ง','สยอง','ถูกใจ','ทึ่ง','หลงรัก','ซึ้ง']
+__emotion_pattern = re.compile('|'.join(__emotions))
+
+def url_of(topic_id):
+  return '{0}/topic/{1}'.format(PANTIP_URL,topic_id)
+
+# @param {int} topic_id
+# @param {str} extraction engine, [dom] or [stream]
+# @param {htmlcache.HtmlCache} cache of the raw pages (optional)
+# @param {bool} read the page from the cache instead of the network
+def scrape(topic_id,engine=None,cache=None,replay=False):
+  if replay:
+    html = cache.get(topic_id)
+    if html is None: raise KeyError('Topic #{0} is not cached'.format(topic_id))
+    return scrape_html(topic_id,html,engine)
+
+  url  = url_of(topic_id)
   print(colored('Fetching: ','green') + colored(url,'cyan'))
+
+  if (engine or ENGINE)=='stream' or cache is not None:
+    with urlopen(url) as resp:
+      html = resp.read().decode('utf-8')
+    if cache is not None: cache.put(topic_id,html)
+    return scrape_html(topic_id,html,engine)
+
+  # Download the topic and create DOM over it
   page = htmldom.HtmlDom(url).createDom()
+  return extract(topic_id,page)
+
+# Scrape the topic from the downloaded HTML string
+# @param {int} topic_id
+# @param {str} html
+# @param {str} extraction engine, [dom] or [stream]
+def scrape_html(topic_id,html,engine=None):
+  if (engine or ENGINE)=='stream':
+    from . import streamscraper
+    return streamscraper.extract(topic_id,html)
 
+  page = htmldom.HtmlDom().createDom(html)
+  return extract(topic_id,page)
+
+# Extract the scrape record out of the topic DOM
+# @return {dict} or None if the topic was deleted
+def extract(topic_id,page):
   # Deleted topic?
   if page.find('.callback-status') \
   and 'กระทู้นี้ถูกลบเนื่องจาก' in page.find('.callback-status').text():
@@ -22,10 +67,10 @@ def scrape(topic_id):
   title = page.find('h2.display-post-title').text()
   topic = page.find('.display-post-story').text()
   tags  = parse_tags(page.find('.display-post-tag-wrapper')[:])
-  
+
   svote = page.find('.like-score').text()
   sreact = page.find('.emoticon-score').text()
-  
+
   vote  = int(svote) if svote else 0 # Number of votes
   react = int(sreact) if sreact else 0  # Number of reactions
   emoti = extract_emotions(page.find('.emotion-vote-user').text())
@@ -49,7 +94,8 @@ def parse_tags(tags):
   return tags
 
 
+# Count all the emotions in a single scan
 def extract_emotions(emoti_str):
-  __emotions = ['ขำกลิ้ง','สยอง','ถูกใจ','ทึ่ง','หลงรัก','ซึ้ง']
-  emotions = [(e,emoti_str.count(e))  for e in __emotions]
-  return emotions
\ No newline at end of file
+  counts = Counter(__emotion_pattern.findall(emoti_str))
+  emotions = [(e,counts[e]) for e in __emotions]
+  return emotions
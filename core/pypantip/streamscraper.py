@@ -0,0 +1,136 @@
+"""
+Streaming Pantip extractor
+---------------------------
+Extract the topic out of the raw HTML in one event-based
+pass, without building the DOM. Parsing stops as soon
+as every field of the scrape record has been captured.
+Texts are joined the same way `htmldom` does so both
+engines produce identical records.
+
+@starcolon projects
+"""
+
+from html.parser import HTMLParser
+from termcolor import colored
+from . import scraper
+
+CHUNK_SIZE = 16384
+DELETED    = 'กระทู้นี้ถูกลบเนื่องจาก'
+
+# CSS class (and tag, if any) of each field to capture
+FIELDS = {
+  'display-post-title':       ('title','h2'),
+  'display-post-story':       ('topic',None),
+  'display-post-tag-wrapper': ('tags',None),
+  'like-score':               ('vote',None),
+  'emoticon-score':           ('react',None),
+  'emotion-vote-user':        ('emoti',None),
+  'callback-status':          ('status',None)
+}
+REQUIRED = set(f for f,_ in FIELDS.values()) - set(['status'])
+
+VOID_TAGS = set([
+  'area','base','br','col','embed','hr','img','input',
+  'link','meta','param','source','track','wbr'
+])
+
+class StopParsing(Exception):
+  pass
+
+class TopicParser(HTMLParser):
+  def __init__(self):
+    HTMLParser.__init__(self,convert_charrefs=False)
+    self.found    = {}
+    self.stack    = []  # Open tag names
+    self.captures = []  # [(field, depth, buffers)]
+    self.fresh    = True # Whether a new text node begins
+
+  def handle_starttag(self,tag,attrs):
+    self.fresh = True
+    if tag in VOID_TAGS:
+      self.handle_startendtag(tag,attrs)
+      return
+
+    self.stack.append(tag)
+    for c in self.captures: c[2].append([])
+
+    classes = (dict(attrs).get('class') or '').split()
+    for cls in classes:
+      if cls not in FIELDS: continue
+      field,only_tag = FIELDS[cls]
+      if field in self.found or (only_tag and only_tag!=tag): continue
+      if any(c[0]==field for c in self.captures): continue
+      self.captures.append((field,len(self.stack),[[]]))
+
+  def handle_startendtag(self,tag,attrs):
+    # An empty element contributes a line break to its parent
+    self.fresh = True
+    for c in self.captures: c[2][-1].append('\n')
+
+  def handle_endtag(self,tag):
+    self.fresh = True
+    if tag not in self.stack: return # Stray closing tag
+    # Implicitly close the unclosed descendants too
+    while self.stack:
+      depth = len(self.stack)
+      name  = self.stack.pop()
+      self.__close(depth)
+      if name==tag: break
+
+    if REQUIRED <= set(self.found):
+      raise StopParsing()
+
+  def __close(self,depth):
+    remaining = []
+    for field,at,buffers in self.captures:
+      text = ''.join(buffers.pop())
+      if at==depth:
+        self.found[field] = text
+        continue
+      buffers[-1].append(text + '\n')
+      remaining.append((field,at,buffers))
+    self.captures = remaining
+
+  def handle_data(self,data):
+    # Leading spaces of a text node are dropped
+    if self.fresh:
+      data = data.lstrip()
+      if len(data)==0: return
+      self.fresh = False
+    for c in self.captures: c[2][-1].append(data)
+
+  def handle_entityref(self,name):
+    self.handle_data('&{0};'.format(name))
+
+  def handle_charref(self,name):
+    self.handle_data('&#{0};'.format(name))
+
+# Extract the scrape record out of the raw HTML
+# @return {dict} or None if the topic was deleted
+def extract(topic_id,html):
+  parser = TopicParser()
+  try:
+    for i in range(0,len(html),CHUNK_SIZE):
+      parser.feed(html[i:i+CHUNK_SIZE])
+    parser.close()
+  except StopParsing:
+    pass
+
+  found = parser.found
+  if DELETED in found.get('status',''):
+    print(colored('DELETED TOPIC','red'))
+    return None
+
+  svote  = found.get('vote','')
+  sreact = found.get('react','')
+
+  return {
+    'topic_id': topic_id,
+    'title': found.get('title',''),
+    'topic': found.get('topic',''),
+    # As the DOM engine, no tag wrapper makes a single empty tag
+    'tags': found.get('tags','').split('\n'),
+    'vote': int(svote) if svote else 0,
+    'react': int(sreact) if sreact else 0,
+    'emoti': scraper.extract_emotions(found.get('emoti',''))
+  }
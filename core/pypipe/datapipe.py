@@ -4,28 +4,103 @@ Data Processing Pipeline
 """
 
 import json
+import threading
 import numpy as np
-from .pipe import Pipe
+from queue import Queue
+from .pipe import Pipe, chunks
+from . import metrics
+from . import profiling
+import time
 from termcolor import colored
 from .operations import rabbit
+from .operations import seglog
 from .operations import tapper
 
+# Records of the source, read lazily
+# @param {Any} iterable, rabbit.Feeder or seglog.Segments
+def read(src):
+  if isinstance(src,rabbit.Feeder):
+    return rabbit.iter(src)
+  if isinstance(src,seglog.Segments):
+    return seglog.iter(src)
+  return src
+
+# Stream the source through the transformation, lazily.
+# Without [chunk_size], the transformation takes one record
+# and returns one output. With [chunk_size], it takes a list
+# of records and returns an iterable of outputs
+# (e.g. a fitted sklearn transformer), so no more than one
+# chunk is held in memory at a time.
+# @param {Any} iterable, rabbit.Feeder or seglog.Segments
+# @param {Function} transformer function
+# @param {int} chunk_size (optional)
+# @param {int} buffer_size, records read ahead in background (optional)
+# @param {str} title, the stage name in the metrics (optional)
+def stream(src,transform=lambda d:d,chunk_size=None,buffer_size=0,title='stream'):
+  _src = read(src)
+  if buffer_size>0: _src = buffered(_src,buffer_size,title)
+  transform = metrics.wrap(title,profiling.wrap(title,transform),chunked=bool(chunk_size))
+
+  if chunk_size:
+    for chunk in chunks(_src,chunk_size):
+      yield from transform(chunk)
+  else:
+    for s in _src:
+      yield transform(s)
+
+# Read the iterable ahead in a background thread,
+# holding up to [size] records
+def buffered(iterable,size,title='buffer'):
+  q    = Queue(maxsize=size)
+  done = object()
+  def produce():
+    try:
+      for a in iterable: q.put((a,None))
+      q.put((done,None))
+    except Exception as e:
+      q.put((done,e))
+  threading.Thread(target=produce,daemon=True).start()
+
+  while True:
+    if metrics.enabled:
+      t0 = time.perf_counter()
+      a,error = q.get()
+      metrics.wait(title,time.perf_counter()-t0)
+    else:
+      a,error = q.get()
+    if a is done:
+      if error is not None: raise error
+      return
+    yield a
+
+# Join the rows of the sources side by side
+# into a single matrix
+# @param {Iterable} of rows (vectors, sparse rows) for each source
+# @return {numpy.ndarray}
+def hstack(*sources):
+  def rows(src):
+    return np.vstack([
+      r.toarray().ravel() if hasattr(r,'toarray') else np.asarray(r).ravel()
+      for r in src])
+  return np.hstack([rows(src) for src in sources])
+
 # Pipe input to the destination MQ with
 # particular transformation
 # @param {Any} input
 # @param {list} destination mq(s) to feed
 # @param {Function} trasnformer function
 # @param {String} title of this pipe (optional)
-def pipe(src,dests,transform=lambda d:d,title=''):
+# @param {int} chunk_size, transform the input in chunks (optional)
+def pipe(src,dests,transform=lambda d:d,title='',chunk_size=None):
   print(colored('  pipe @{0} started'.format(title),'yellow'))
 
-  if isinstance(src,rabbit.Feeder):
-    _src = rabbit.iter(src)
+  if chunk_size:
+    # Transform the input lazily, chunk by chunk
+    outcome = stream(src,transform,chunk_size,title=title or 'pipe')
   else:
-    _src = src
-  
-  # Transform the input at once
-  outcome = transform(_src)
+    # Transform the input at once
+    transform = profiling.wrap(title or 'pipe',transform)
+    outcome   = metrics.wrap(title or 'pipe',transform,chunked=True)(read(src))
 
   # Feed the output to destination queues if supplied
   if dests and len(dests)>0:
@@ -39,24 +114,32 @@ def pipe(src,dests,transform=lambda d:d,title=''):
 # @param {list} destination mq(s) to feed
 # @param {Function} transformer function
 # @param {String} title of this pipe (optional)
+# @return {int} number of records processed
 def pipe_each(src,dests,transform=lambda d:d,title=''):
   print(colored('  pipe @{0} started'.format(title),'yellow'))
 
-  if isinstance(src,rabbit.Feeder):
-    _src = rabbit.iter(src)
-  else:
-    _src = src
-
+  feed = rabbit.feed(dests) if dests and len(dests)>0 else None
   n = 0
   # Transform the input one-by-one
-  for s in _src:
-    outcome = transformer(s)
-    # Feed the record
-    safe_feed(dests,outcome)
+  for outcome in stream(src,transform,title=title or 'pipe_each'):
+    # Feed the record as a single message
+    if feed is not None: feed(to_message(outcome))
+    n += 1
+
+  print(colored(title,'cyan'), colored(' [DONE] {0} records'.format(n),'green'))
+  return n
 
-  print(colored(title,'cyan'), colored(' [DONE]','green'))  
+# Serialise a single record into an MQ message
+def to_message(a):
+  if isinstance(a,str): return a
+  if isinstance(a,np.ndarray): return a # Sent in the binary array format
+  if type(a).__module__ == 'numpy' or isinstance(a,(float,int)):
+    return str(a)
+  try:
+    return json.dumps(a)
+  except TypeError:
+    return str(a)
 
-  
 # Safely dump a data to the destination MQs
 # @param {list} of rabbit.Feeder
 # @param {Any} list, iterable, numpy.array, object, etc.
@@ -72,8 +155,8 @@ def safe_feed(mqs,data):
 
   def to_str(el):
     if isinstance(el,np.ndarray):
-      # Numpy array
-      return json.dumps(list(el))
+      # Numpy array, sent in the binary array format
+      return el
     elif type(data).__module__ == 'numpy':
       # Any numeric numpy types
       return str(el)
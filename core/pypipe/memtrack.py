@@ -0,0 +1,122 @@
+"""
+Memory tracking of the processing steps
+---------------------------
+Each step records its peak resident memory (sampled),
+the growth of the Python heap (tracemalloc, opt-in as it
+slows down the allocations), and the shapes, dtypes and
+sizes of the matrices noted along the way.
+
+  with memtrack.step('Vectorisation'):
+    X = vectorise(texts)
+    memtrack.note('X',X)
+
+@starcolon projects
+"""
+
+from termcolor import colored
+import contextlib
+import tracemalloc
+import threading
+import resource
+import time
+import os
+
+_1MB = 1048576
+
+enabled  = False
+interval = 0.05 # seconds between the RSS samples
+steps    = [] # Finished steps, in order
+__open   = [] # Running steps (nested)
+__lock   = threading.Lock()
+
+# @param {bool} trace, whether to trace the Python allocations as well
+def enable(trace=False):
+  global enabled
+  enabled = True
+  if trace and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+# Resident memory of the process now (bytes)
+def rss():
+  try:
+    with open('/proc/self/statm') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (OSError,ValueError):
+    return max_rss()
+
+# Peak resident memory of the process so far (bytes)
+def max_rss():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Shape, dtype and size of a matrix (dense or sparse)
+def describe(m):
+  info = {'type': type(m).__name__}
+  if hasattr(m,'shape'): info['shape'] = list(m.shape)
+  if hasattr(m,'dtype'): info['dtype'] = str(m.dtype)
+  if hasattr(m,'nnz'):
+    # Sparse matrix, the size of its underlying arrays
+    info['nnz']    = int(m.nnz)
+    info['nbytes'] = int(sum(getattr(m,a).nbytes for a in ('data','indices','indptr','row','col') if hasattr(m,a)))
+  elif hasattr(m,'nbytes'):
+    info['nbytes'] = int(m.nbytes)
+  elif isinstance(m,list):
+    info['shape'] = [len(m)]
+  return info
+
+# Note the matrix produced by the current step
+def note(name,m):
+  if not enabled or len(__open)==0: return
+  __open[-1]['matrices'][name] = describe(m)
+
+# Track the memory of the enclosed step
+@contextlib.contextmanager
+def step(name):
+  if not enabled:
+    yield None
+    return
+
+  rec = {'step': name, 'matrices': {}, 'rss_before': rss()}
+  rec['rss_peak'] = rec['rss_before']
+  tracing = tracemalloc.is_tracing()
+  if tracing:
+    heap0 = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+
+  # Sample the resident memory while the step runs
+  done = threading.Event()
+  def sample():
+    while not done.wait(interval):
+      rec['rss_peak'] = max(rec['rss_peak'],rss())
+  sampler = threading.Thread(target=sample,daemon=True)
+  sampler.start()
+
+  __open.append(rec)
+  t0 = time.time()
+  try:
+    yield rec
+  finally:
+    __open.pop()
+    done.set()
+    sampler.join()
+    rec['elapsed']   = time.time() - t0
+    rec['rss_after'] = rss()
+    rec['rss_peak']  = max(rec['rss_peak'],rec['rss_after'])
+    rec['max_rss']   = max_rss()
+    if tracing:
+      heap,peak = tracemalloc.get_traced_memory()
+      rec['heap_delta'] = heap - heap0
+      rec['heap_peak']  = peak - heap0
+    with __lock: steps.append(rec)
+
+def report():
+  if len(steps)==0: return
+  print(colored('[Memory by step]','cyan'))
+  for s in steps:
+    line = '  {0:<20} peak RSS {1:>9.1f} MB  (+{2:.1f} MB)  {3:.1f} s'.format(
+      s['step'],s['rss_peak']/_1MB,(s['rss_peak']-s['rss_before'])/_1MB,s['elapsed'])
+    if 'heap_peak' in s:
+      line += '  heap peak +{0:.1f} MB'.format(s['heap_peak']/_1MB)
+    print(line)
+    for name,m in s['matrices'].items():
+      print('      {0:<16} {1} {2} {3:.1f} MB'.format(
+        name,m.get('shape'),m.get('dtype',''),m.get('nbytes',0)/_1MB))
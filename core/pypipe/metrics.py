@@ -0,0 +1,216 @@
+"""
+Pipeline stage metrics
+---------------------------
+Per-stage call counts, records in & out, wall & CPU time,
+latency percentiles and queue wait. Off by default; when off
+the pipes run their tasks unwrapped.
+
+  PYPIPE_METRICS=1           enable
+  PYPIPE_METRICS_EVERY=30    print a summary every 30 seconds
+  PYPIPE_METRICS_DUMP=path   dump the stats as JSON on exit
+
+@starcolon projects
+"""
+
+from termcolor import colored
+import threading
+import functools
+import asyncio
+import atexit
+import operator
+import random
+import json
+import time
+import os
+
+SAMPLES = 1024 # Latencies kept per stage (reservoir)
+
+enabled    = False
+generation = 0 # Bumped on every (re)configuration
+__stats    = {}
+__lock     = threading.Lock()
+__reporter = None
+
+class StageStats(object):
+  def __init__(self,name):
+    self.name        = name
+    self.calls       = 0
+    self.records_in  = 0
+    self.records_out = 0
+    self.wall        = 0.0
+    self.cpu         = 0.0
+    self.wait        = 0.0 # Queue wait before the stage
+    self.waits       = 0
+    self.latencies   = []
+    self.seen        = 0 # Latencies offered to the reservoir
+
+  def add_latency(self,t):
+    self.seen += 1
+    if len(self.latencies)<SAMPLES:
+      self.latencies.append(t)
+    else:
+      i = random.randrange(self.seen)
+      if i<SAMPLES: self.latencies[i] = t
+
+  def merge(self,other):
+    self.calls       += other['calls']
+    self.records_in  += other['records_in']
+    self.records_out += other['records_out']
+    self.wall        += other['wall']
+    self.cpu         += other['cpu']
+    self.wait        += other['wait']
+    self.waits       += other['waits']
+    for t in other['latencies']: self.add_latency(t)
+
+  def percentile(self,p):
+    if len(self.latencies)==0: return 0.0
+    ordered = sorted(self.latencies)
+    return ordered[min(len(ordered)-1,int(p/100*len(ordered)))]
+
+  def summary(self):
+    return {
+      'calls':       self.calls,
+      'records_in':  self.records_in,
+      'records_out': self.records_out,
+      'wall':        self.wall,
+      'cpu':         self.cpu,
+      'wait':        self.wait,
+      'waits':       self.waits,
+      'p50':         self.percentile(50),
+      'p90':         self.percentile(90),
+      'p99':         self.percentile(99),
+      'records_per_sec': self.records_in/self.wall if self.wall>0 else 0.0
+    }
+
+  def raw(self):
+    return dict(self.summary(),latencies=self.latencies[:])
+
+
+# Turn the instrumentation on
+# @param {int} report_every, seconds between the printed summaries (optional)
+# @param {str} dump_path, JSON file written on exit (optional)
+def enable(report_every=None,dump_path=None):
+  global enabled,generation,__reporter
+  enabled     = True
+  generation += 1
+  if report_every and __reporter is None:
+    __reporter = threading.Thread(target=__report_loop,args=(report_every,),daemon=True)
+    __reporter.start()
+  if dump_path:
+    atexit.register(dump,dump_path)
+
+def disable():
+  global enabled,generation
+  enabled     = False
+  generation += 1
+
+def __report_loop(every):
+  while True:
+    time.sleep(every)
+    if enabled: report()
+
+def stage(name):
+  with __lock:
+    if name not in __stats: __stats[name] = StageStats(name)
+    return __stats[name]
+
+# Number of records, if known
+def __size(a):
+  return operator.length_hint(a,1)
+
+# Account one call of the stage
+def record(name,n_in,n_out,wall,cpu):
+  s = stage(name)
+  with __lock:
+    s.calls       += 1
+    s.records_in  += n_in
+    s.records_out += n_out
+    s.wall        += wall
+    s.cpu         += cpu
+    s.add_latency(wall)
+
+# Account the time a record (or chunk) waited before the stage
+def wait(name,seconds):
+  s = stage(name)
+  with __lock:
+    s.wait  += seconds
+    s.waits += 1
+
+# Wrap the stage function with the instrumentation
+# (the function itself if the metrics are off)
+# @param {str} name of the stage
+# @param {Function} fn
+# @param {bool} chunked, whether the function takes a list of records
+def wrap(name,fn,chunked=False):
+  if not enabled: return fn
+
+  if asyncio.iscoroutinefunction(fn):
+    @functools.wraps(fn)
+    async def timed_async(a):
+      t0 = time.perf_counter()
+      out = await fn(a)
+      # CPU time is not attributable across awaits
+      record(name,__size(a) if chunked else 1,__size(out) if chunked else 1,time.perf_counter()-t0,0.0)
+      return out
+    return timed_async
+
+  @functools.wraps(fn)
+  def timed(a):
+    t0,c0 = time.perf_counter(),time.thread_time()
+    out = fn(a)
+    wall,cpu = time.perf_counter()-t0,time.thread_time()-c0
+    if chunked: record(name,__size(a),0 if out is None else __size(out),wall,cpu)
+    else: record(name,1,0 if out is None else 1,wall,cpu)
+    return out
+  return timed
+
+# Wrap the pipe task along with its batch & async variants
+def wrap_task(name,task):
+  if not enabled: return task
+  timed = wrap(name,task)
+  if hasattr(task,'batch'): timed.batch = wrap(name,task.batch,chunked=True)
+  if hasattr(task,'aio'): timed.aio = wrap(name,task.aio)
+  return timed
+
+def snapshot():
+  with __lock:
+    return {name: s.summary() for name,s in __stats.items()}
+
+# Hand over the stats collected so far (and reset them),
+# e.g. from a worker process to the parent
+def drain():
+  global __stats
+  with __lock:
+    stats,__stats = __stats,{}
+  return {name: s.raw() for name,s in stats.items()}
+
+def merge(stats):
+  for name,other in stats.items():
+    s = stage(name)
+    with __lock: s.merge(other)
+
+def reset():
+  with __lock: __stats.clear()
+
+def report():
+  stats = snapshot()
+  if len(stats)==0: return
+  print(colored('[Stage metrics]','cyan'))
+  print('  {0:<36} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>9} {7:>9} {8:>9} {9:>9}'.format(
+    'stage','calls','in','out','wall s','cpu s','wait s','p50 ms','p99 ms','rec/s'))
+  for name,s in sorted(stats.items(),key=lambda kv: -kv[1]['wall']):
+    print('  {0:<36} {1:>8} {2:>9} {3:>9} {4:>9.2f} {5:>9.2f} {6:>9.2f} {7:>9.2f} {8:>9.2f} {9:>9.1f}'.format(
+      name[:36],s['calls'],s['records_in'],s['records_out'],s['wall'],s['cpu'],s['wait'],
+      1000*s['p50'],1000*s['p99'],s['records_per_sec']))
+
+def dump(path):
+  with open(path,'w') as f:
+    json.dump(snapshot(),f,indent=2)
+  print(colored('Stage metrics written to {0}'.format(path),'green'))
+
+
+if os.getenv('PYPIPE_METRICS'):
+  enable(
+    report_every=int(os.getenv('PYPIPE_METRICS_EVERY','0')) or None,
+    dump_path=os.getenv('PYPIPE_METRICS_DUMP') or None
+  )
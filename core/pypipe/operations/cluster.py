@@ -7,15 +7,14 @@ import os
 import pickle
 import numpy as np
 from termcolor import colored
+from .. import memtrack
 from sklearn.svm import SVC
 from sklearn.cluster import KMeans
 from sklearn.feature_selection import SelectKBest, chi2, f_classif
 from sklearn.neighbors import KNeighborsClassifier
-from sklearn.neighbors.nearest_centroid import NearestCentroid
-# TAOTOREVIEW: [ShuffleSplit] will be deprecated in 0.18
-# and will be moved to [sklearn.model_selection]
-from sklearn.cross_validation import ShuffleSplit
-from sklearn.qda import QDA
+from sklearn.neighbors import NearestCentroid
+from sklearn.model_selection import ShuffleSplit
+from sklearn.discriminant_analysis import QuadraticDiscriminantAnalysis as QDA
 from sklearn.linear_model import SGDClassifier
 
 METHODS = {
@@ -30,9 +29,9 @@ METHODS = {
   ),
   'qda': QDA(),
   'sgd': SGDClassifier(
-    loss='squared_loss',
+    loss='squared_error',
     penalty='l2', # Equivalent to SVM (Norm-2)
-    n_iter=10
+    max_iter=10
   ),
   'svm': SVC(
     kernel='rbf', gamma=0.1,
@@ -77,8 +76,8 @@ def analyze(clf,labels=None):
     if labels:  # Learning mode
 
       # Split train & test folds
-      shuffle = ShuffleSplit(len(matrix), test_size=test_ratio)
-      trainlist, testlist = [(a,b) for (a,b) in shuffle][-1]
+      shuffle = ShuffleSplit(n_splits=1, test_size=test_ratio)
+      trainlist, testlist = next(shuffle.split(matrix))
       X_train = [x for x in map(lambda i: matrix[i], trainlist)]
       Y_train = [y for y in map(lambda i: labels[i], trainlist)]
       X_valid = [x for x in map(lambda i: matrix[i], testlist)]
@@ -93,11 +92,14 @@ def analyze(clf,labels=None):
       print(colored('y: {0}'.format(np.shape(Y_train)),'yellow'))
 
       # Process trainset
-      for opr in clf[:-1]:
-        print(colored(opr,'yellow'))
-        X_train = opr.fit_transform(X_train,Y_train)
+      with memtrack.step('Selection'):
+        for opr in clf[:-1]:
+          print(colored(opr,'yellow'))
+          X_train = opr.fit_transform(X_train,Y_train)
+        memtrack.note('X_train',X_train)
       # NOTE: The last operation of the CLF is always a clustering algo
-      clf[-1].fit(X_train,Y_train)
+      with memtrack.step('Fit'):
+        clf[-1].fit(X_train,Y_train)
 
       # Display the dimension of the training elements
       print(colored('Validation set:','cyan'))
@@ -105,13 +107,16 @@ def analyze(clf,labels=None):
       print(colored('y: {0}'.format(np.shape(Y_valid)),'yellow'))
 
       # Process validation set
-      for opr in clf[:-1]:
-        print(colored(opr,'yellow'))
-        X_valid = opr.transform(X_valid)
+      with memtrack.step('Validation'):
+        for opr in clf[:-1]:
+          print(colored(opr,'yellow'))
+          X_valid = opr.transform(X_valid)
+        memtrack.note('X_valid',X_valid)
+        Y_pred = clf[-1].predict(X_valid)
 
       # Return tuple of [actual], [prediction] 
       # on the validation set
-      return (Y_valid, clf[-1].predict(X_valid))
+      return (Y_valid, Y_pred)
 
     else: # Classification mode
       X = matrix
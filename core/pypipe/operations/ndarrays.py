@@ -0,0 +1,33 @@
+"""
+Binary array messages
+---------------------------
+  b'NDA1' + uint32 header length + JSON header {dtype, shape}
+  followed by the raw (C-ordered) buffer of the array
+
+Shared by the data relays (rabbit, seglog).
+
+@starcolon projects
+"""
+
+import numpy as np
+import struct
+import json
+
+NDARRAY_TYPE  = 'application/x-ndarray'
+NDARRAY_MAGIC = b'NDA1'
+
+# Pack the array into a binary message body,
+# its buffer is taken as is
+def pack_array(a):
+  a = np.require(a,requirements='C')
+  header = json.dumps({'dtype': a.dtype.str, 'shape': a.shape}).encode('utf-8')
+  return b''.join([NDARRAY_MAGIC,struct.pack('<I',len(header)),header,memoryview(a.reshape(-1).view(np.uint8))])
+
+# Rebuild the array over the message body (no copy, read-only)
+def unpack_array(body):
+  if body[:4]!=NDARRAY_MAGIC:
+    raise ValueError('Not an array message')
+  n = struct.unpack('<I',body[4:8])[0]
+  header = json.loads(str(body[8:8+n],'utf-8'))
+  a = np.frombuffer(body,dtype=np.dtype(header['dtype']),offset=8+n)
+  return a.reshape(header['shape'])
@@ -3,20 +3,91 @@ Pantip thread record pre-processing pipe
 @starcolon projects
 """
 
-from multiprocessing import Pool
+from collections import OrderedDict
 from termcolor import colored
 from . import tokenizer
-import json
+from . import tokencache
+
+# Tokenised texts are memorised in-process by default
+cache = tokencache.TokenCache(tokenizer.version)
+
+# Replace the tokenisation cache, e.g. to back it with an on-disk store
+# @param {int} memory limit of the in-process LRU (bytes)
+# @param {str} path of the on-disk store (optional)
+def use_cache(max_bytes=64*tokencache._1MB,path=None):
+  global cache
+  if cache is not None: cache.close()
+  cache = tokencache.TokenCache(tokenizer.version,max_bytes,path)
+  return cache
+
+# Tokenise the texts, only those not seen before
+# go to the tokeniser service
+def tokenize(texts):
+  if cache is None: return tokenizer.tokenize_many(texts)
+
+  results = [cache.get(t) for t in texts]
+  misses  = list(OrderedDict.fromkeys(t for t,r in zip(texts,results) if r is None))
+  if len(misses)>0:
+    fresh = dict(zip(misses,tokenizer.tokenize_many(misses)))
+    for t,words in fresh.items(): cache.put(t,words)
+    results = [fresh[t] if r is None else r for t,r in zip(texts,results)]
+  return results
+
+async def tokenize_async(texts):
+  if cache is None: return await tokenizer.tokenize_many_async(texts)
+
+  results = [cache.get(t) for t in texts]
+  misses  = list(OrderedDict.fromkeys(t for t,r in zip(texts,results) if r is None))
+  if len(misses)>0:
+    fresh = dict(zip(misses,await tokenizer.tokenize_many_async(misses)))
+    for t,words in fresh.items(): cache.put(t,words)
+    results = [fresh[t] if r is None else r for t,r in zip(texts,results)]
+  return results
 
 def take(record):
-  package = {
-    'data':[record['title'],record['topic']]
-  }
-  
-  results = tokenizer.tokenize(json.dumps(package,ensure_ascii=False))
-  record['title'] = ' '.join(results['data'][0])
-  record['topic'] = ' '.join(results['data'][1])
+  # Concurrent callers share the batched tokeniser requests
+  results = tokenize([record['title'],record['topic']])
+  record['title'] = ' '.join(results[0])
+  record['topic'] = ' '.join(results[1])
 
   return record
 
+async def take_async(record):
+  results = await tokenize_async([record['title'],record['topic']])
+  record['title'] = ' '.join(results[0])
+  record['topic'] = ' '.join(results[1])
+
+  return record
+
+# Tokenise multiple records at once
+# @param {list} of records
+# @return {list} of records
+def take_many(records):
+  texts   = [t for r in records for t in (r['title'],r['topic'])]
+  results = tokenize(texts)
+  for i,record in enumerate(records):
+    record['title'] = ' '.join(results[2*i])
+    record['topic'] = ' '.join(results[2*i+1])
+
+  return records
+
+# Prepare [take] in a parallel pipe worker. The worker keeps
+# the inherited in-memory cache, while its fresh results are
+# handed back to the parent which owns the on-disk store.
+def spawn_take():
+  if cache is not None: cache.detach()
+  return take
+
+def collect_fresh():
+  return cache.drain() if cache is not None else None
+
+def merge_fresh(entries):
+  if cache is None: return
+  for text,words in entries: cache.put(text,words)
 
+# [take] processes a chunk of records through [take_many]
+take.batch   = take_many
+take.aio     = take_async
+take.spawn   = (spawn_take,())
+take.collect = collect_fresh
+take.merge   = merge_fresh
@@ -6,18 +6,23 @@ RabbitMQ data relay
 
 from termcolor import colored
 from queue import Queue
+from .ndarrays import NDARRAY_TYPE, pack_array, unpack_array
 import numpy as np
-import signal
 import time
 import pika
 import json
 
 # Iterable feeder
 class Feeder(object):
-  def __init__(self,conn,channel,q):
-    self.conn    = conn
-    self.channel = channel
-    self.q       = q
+  def __init__(self,conn,channel,q,server_addr='localhost',exchange=''):
+    self.conn        = conn
+    self.channel     = channel
+    self.q           = q # Queue name, or the routing key on an exchange
+    self.exchange    = exchange
+    self.server_addr = server_addr
+    self.recipe      = (create,(server_addr,q)) # To reconnect from another process
+    self.blocked     = False # Whether the broker blocks the publishers
+    self.publishers  = [] # Buffering publishers, flushed on end
   def components(self):
     return (self.conn,self.channel,self.q)
 
@@ -27,9 +32,35 @@ def create(server_addr,q):
   conn = pika.BlockingConnection(pika.ConnectionParameters(server_addr))
   channel = conn.channel()
   channel.queue_declare(queue=q)
-  feeder = Feeder(conn,channel,q)
+  feeder = Feeder(conn,channel,q,server_addr)
+  __watch_blocked(feeder)
   return feeder
 
+# Create a feeder which publishes to an exchange, the broker
+# delivers a copy of each message to every bound queue
+# @param {str} server_addr
+# @param {str} exchange name
+# @param {list} of queue names, or (queue name, binding key) for a topic exchange
+# @param {str} kind of the exchange, [fanout] or [topic]
+# @param {str} routing_key of the published messages (topic exchange)
+def create_exchange(server_addr,exchange,queues,kind='fanout',routing_key=''):
+  conn = pika.BlockingConnection(pika.ConnectionParameters(server_addr))
+  channel = conn.channel()
+  channel.exchange_declare(exchange=exchange,exchange_type=kind)
+  for q in queues:
+    q,key = q if isinstance(q,tuple) else (q,'#' if kind=='topic' else '')
+    channel.queue_declare(queue=q)
+    channel.queue_bind(queue=q,exchange=exchange,routing_key=key)
+  feeder = Feeder(conn,channel,routing_key,server_addr,exchange)
+  feeder.recipe = (create_exchange,(server_addr,exchange,queues,kind,routing_key))
+  __watch_blocked(feeder)
+  return feeder
+
+# The broker blocks the publishers when it runs low on resources
+def __watch_blocked(feeder):
+  feeder.conn.add_on_connection_blocked_callback(lambda *args: setattr(feeder,'blocked',True))
+  feeder.conn.add_on_connection_unblocked_callback(lambda *args: setattr(feeder,'blocked',False))
+
 def purge(feeder,qlist):
   conn,channel,q = feeder.components()
   for q in qlist:
@@ -39,65 +70,183 @@ def purge(feeder,qlist):
       # Q is not up, but we ignore the unwanted error
       pass
 
-# @param {list} of feeders
-# @return {Record} it remains unchanged 
-def feed(feeders):
-  def feed_message(record,no_parse=False):
+# Serialise the record into a message body and its properties
+def encode(record,no_parse=False):
+  if isinstance(record,str) or no_parse:
+    return record,None
+  if isinstance(record,np.ndarray) and not record.dtype.hasobject:
+    return pack_array(record),pika.BasicProperties(content_type=NDARRAY_TYPE)
+  if isinstance(record,np.ndarray): record = record.tolist()
+  return json.dumps(record,ensure_ascii=False),None
+
+# Deserialise the message body by its content type
+def decode(prop,body):
+  if prop is not None and prop.content_type==NDARRAY_TYPE:
+    return unpack_array(body)
+  return body.decode('utf-8')
+
+# Publisher of the serialised messages to the MQs,
+# optionally buffered and sent in batches
+class Publisher(object):
+  # @param {list} of feeders
+  # @param {int} batch_size, messages buffered before sending (0: send at once)
+  # @param {bool} confirm, wait for the broker to confirm each message
+  # @param {int} blocked_timeout, seconds to wait for a blocking broker
+  def __init__(self,feeders,batch_size=0,confirm=False,blocked_timeout=60):
+    self.feeders         = feeders
+    self.batch_size      = batch_size
+    self.confirm         = confirm
+    self.blocked_timeout = blocked_timeout
+    self.buffer          = []
     for feeder in feeders:
-      conn,channel,q = feeder.components()
-      
-      # Make sure the data type is compatible
-      if isinstance(record,str) or no_parse:
-        data = record
-      else:
-        data = json.dumps(record,ensure_ascii=False)
+      if batch_size>0: feeder.publishers.append(self)
+      if confirm: feeder.channel.confirm_delivery()
 
+  def publish(self,body,props=None):
+    self.buffer.append((body,props))
+    if len(self.buffer)>=max(1,self.batch_size): self.flush()
+
+  # Send all the buffered messages
+  def flush(self):
+    if len(self.buffer)==0: return
+    messages,self.buffer = self.buffer,[]
+    for feeder in self.feeders:
       try:
-        channel.basic_publish(
-          exchange='',
-          routing_key=q,
-          body=data)
+        self.__send(feeder,messages)
       except Exception:
-        print(colored('ERROR publishing to MQ #','red'),q)
+        print(colored('ERROR publishing to MQ #','red'),feeder.exchange or feeder.q)
         raise
+
+  def __send(self,feeder,messages):
+    conn,channel,q = feeder.components()
+    self.__wait_unblocked(feeder)
+    for body,props in messages:
+      # With the confirms on, each publish waits for the
+      # broker to acknowledge the message (pika 0.13)
+      sent = channel.basic_publish(exchange=feeder.exchange,routing_key=q,body=body,properties=props)
+      if self.confirm and sent is False:
+        raise IOError('MQ #{0} did not confirm a published message'.format(q))
+
+  # Hold the publishing while the broker blocks the connection
+  def __wait_unblocked(self,feeder):
+    deadline = time.time() + self.blocked_timeout
+    while feeder.blocked:
+      if time.time()>deadline:
+        raise IOError('MQ #{0} has been blocked by the broker for {1} s'.format(feeder.q,self.blocked_timeout))
+      feeder.conn.process_data_events(time_limit=1)
+
+# @param {list} of feeders
+# @param {int} batch_size, messages buffered before publishing (0: publish at once)
+# @param {bool} confirm, wait for the broker to confirm each message
+# @return {Record} it remains unchanged 
+def feed(feeders,batch_size=0,confirm=False):
+  publisher = Publisher(feeders,batch_size,confirm)
+
+  def feed_message(record,no_parse=False):
+    # Make sure the data type is compatible
+    publisher.publish(*encode(record,no_parse))
     return record
+
+  # Publish a chunk of records, each serialised only once
+  def feed_messages(records):
+    for r in records: publisher.publish(*encode(r))
+    return records
+
+  feed_message.flush = publisher.flush
+
+  feed_message.batch = feed_messages
+  # pika connections must not be shared across threads
+  feed_message.threadsafe = False
+  # Parallel pipe workers open their own connections
+  feed_message.spawn = (feed_to,([f.recipe for f in feeders],batch_size,confirm))
+  return feed_message
+
+# Feed the MQs over new connections
+# @param {list} of feeder recipes, (create function, arguments)
+def feed_to(recipes,batch_size=0,confirm=False):
+  feeders = [factory(*args) for factory,args in recipes]
+  feed_message = feed(feeders,batch_size,confirm)
+  feed_message.close = lambda: end_multiple(feeders)
   return feed_message
 
 
 # Message generator
-def iter(feeder,transformation=lambda x:x):
-  TIMEOUT = 5 # seconds
-  # Start the awaiting signal
+# @param {Feeder} feeder of the queue to consume
+# @param {Function} transformation of each message
+# @param {float} timeout, seconds without any message until the iteration ends (None: never)
+# @param {int} prefetch, messages the broker sends ahead of the acks
+# @param {int} ack_every, messages acknowledged at once
+# @param {float} ack_interval, longest delay of an acknowledgement (seconds)
+# @param {int} chunk, yield lists of up to [chunk] messages (optional)
+# @param {float} linger, longest wait for a chunk to fill up (seconds, optional)
+# @param {Function} until, the iteration ends once it returns True (optional)
+#
+# A message is acknowledged once the consumer asks for the next one
+# (or the next chunk), so those not processed are delivered again.
+def iter(feeder,transformation=lambda x:x,timeout=5,prefetch=500,ack_every=100,ack_interval=1.0,chunk=None,linger=None,until=None):
+  channel   = feeder.channel
+  prefetch  = max(prefetch,chunk or 1)
+  ack_every = min(ack_every,prefetch)
+  channel.basic_qos(prefetch_count=prefetch)
+
+  last,pending,acked_at = None,0,time.time()
+  def ack():
+    nonlocal pending,acked_at
+    if pending>0: channel.basic_ack(last,multiple=True)
+    pending,acked_at = 0,time.time()
+
+  # Wake up at least this often without any message
+  waits = [t for t in (timeout,linger if chunk else None,ack_interval) if t]
+  wait  = min(waits) if len(waits)>0 else None
+
+  batch,started,received_at = [],0,time.time()
   try:
-    def __timeout(signum,frame):
-      raise StopIteration
-
-    signal.signal(signal.SIGALRM,__timeout)
-    signal.alarm(TIMEOUT)
-    for methodframe, prop, body in feeder.channel.consume(feeder.q):
-      signal.alarm(0)
-      msg = transformation(body.decode('utf-8'))
-      
-      yield msg
-      feeder.channel.basic_ack(methodframe.delivery_tag)
-      
-      # Startover a new timer
-      signal.alarm(TIMEOUT)
-  
-  except StopIteration as e:
-    signal.alarm(0) # Cancel the timer
-    print(colored('--Timeout, no further message--','magenta'))
-    raise
-  except Exception as e:
-    signal.alarm(0) 
+    for methodframe, prop, body in channel.consume(feeder.q,inactivity_timeout=wait):
+      now = time.time()
+      if methodframe is not None:
+        received_at = now
+        msg = transformation(decode(prop,body))
+        if not chunk:
+          yield msg
+          last,pending = methodframe.delivery_tag,pending+1
+          if pending>=ack_every or time.time()-acked_at>=ack_interval: ack()
+          if until is not None and until(): break
+          continue
+        if len(batch)==0: started = now
+        batch.append((methodframe.delivery_tag,msg))
+
+      if chunk and len(batch)>0 and (len(batch)>=chunk or (linger and now-started>=linger)):
+        yield [m for _,m in batch]
+        last,pending = batch[-1][0],pending+len(batch)
+        batch = []
+        ack()
+
+      if methodframe is None:
+        ack()
+        if timeout is not None and now-received_at>=timeout:
+          print(colored('--Timeout, no further message--','magenta'))
+          break
+
+      if until is not None and until(): break
+
+    # The last partial chunk
+    if chunk and len(batch)>0:
+      yield [m for _,m in batch]
+      last,pending = batch[-1][0],pending+len(batch)
+  except Exception:
     print(colored('--Exception broke the iteration--','magenta'))
     raise
+  finally:
+    if channel.is_open:
+      ack()
+      # The unacknowledged messages go back to the queue
+      channel.cancel()
 
 # Start a message listening loop (endless)
 def listen(feeder,callback):
   def on_message(ch,method,prop,body):
     # Trigger the callback
-    callback(body.decode('utf-8'))
+    callback(decode(prop,body))
     ch.basic_ack(method.delivery_tag)
   feeder.channel.basic_qos(prefetch_count=1)
   feeder.channel.basic_consume(on_message,queue=feeder.q)
@@ -105,8 +254,10 @@ def listen(feeder,callback):
 
 
 def end(feeder):
-  print(colored('Ending MQ #','white'),feeder.q)
+  print(colored('Ending MQ #','white'),feeder.exchange or feeder.q)
   try:
+    # Send what is still buffered
+    for publisher in feeder.publishers: publisher.flush()
     conn,channel,q = feeder.components()
     conn.close()
   except pika.exceptions.ConnectionClosed:
@@ -0,0 +1,252 @@
+"""
+Segment log data relay
+---------------------------
+Append-only, replayable local alternative to the RabbitMQ
+queues, with the same create / feed / iter / end surface.
+Reading never consumes the records: a log can be read again
+from any offset, any number of times.
+
+Each log is a directory of segment files named by the
+offset (in bytes, over the whole log) of their first record:
+
+  <root>/<log>/00000000000000000000.seg
+  <root>/<log>/00000000000067108903.seg
+  <root>/<log>/offsets.json   committed offsets of the named readers
+
+  record : uint32 length + uint32 crc32 + uint8 kind + payload
+  kind   : 0 = UTF-8 text, 1 = array (binary array format, see ndarrays)
+
+Segments are read through mmap; arrays are rebuilt over the
+mapped pages without copying. A log has a single writer.
+
+@starcolon projects
+"""
+
+from termcolor import colored
+from .ndarrays import pack_array, unpack_array
+import numpy as np
+import struct
+import mmap
+import json
+import time
+import zlib
+import os
+
+HEADER      = struct.Struct('<IIB')
+TEXT,ARRAY  = 0,1
+SEGMENT_EXT = '.seg'
+_1MB        = 1048576
+
+class Segments(object):
+  def __init__(self,root,q,segment_bytes=64*_1MB):
+    self.dir           = os.path.join(root,q)
+    self.q             = q
+    self.segment_bytes = segment_bytes
+    self.writer        = None
+    self.writer_base   = None
+    os.makedirs(self.dir,exist_ok=True)
+
+  # Base offsets of the segments, in order
+  def bases(self):
+    return sorted(int(f[:-len(SEGMENT_EXT)]) for f in os.listdir(self.dir) if f.endswith(SEGMENT_EXT))
+
+  def path_of(self,base):
+    return os.path.join(self.dir,'{0:020d}{1}'.format(base,SEGMENT_EXT))
+
+  # Offset right after the last complete record
+  def end_offset(self):
+    bases = self.bases()
+    if len(bases)==0: return 0
+    return bases[-1] + valid_length(self.path_of(bases[-1]))
+
+  def append(self,payload,kind):
+    if self.writer is None:
+      self.__open_writer()
+    elif self.writer.tell()>=self.segment_bytes:
+      # Roll over to a new segment
+      base = self.writer_base + self.writer.tell()
+      self.writer.close()
+      self.writer,self.writer_base = open(self.path_of(base),'ab'),base
+    self.writer.write(HEADER.pack(len(payload),zlib.crc32(payload),kind))
+    self.writer.write(payload)
+
+  def __open_writer(self):
+    bases = self.bases()
+    if len(bases)==0:
+      base = 0
+    else:
+      # Drop the torn record left by an interrupted writer
+      base = bases[-1]
+      path = self.path_of(base)
+      n = valid_length(path)
+      if n<os.path.getsize(path):
+        print(colored('Truncating the torn tail of {0}'.format(path),'yellow'))
+        os.truncate(path,n)
+    self.writer,self.writer_base = open(self.path_of(base),'ab'),base
+
+  def flush(self):
+    if self.writer is not None: self.writer.flush()
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+      self.writer = None
+
+  # Committed offsets of the named readers
+  def offsets(self):
+    path = os.path.join(self.dir,'offsets.json')
+    if not os.path.isfile(path): return {}
+    with open(path) as f:
+      return json.load(f)
+
+  def commit(self,group,offset):
+    offsets = self.offsets()
+    offsets[group] = offset
+    path = os.path.join(self.dir,'offsets.json')
+    with open(path + '.tmp','w') as f:
+      json.dump(offsets,f)
+    os.replace(path + '.tmp',path)
+
+
+# Length of the segment up to its last complete record
+def valid_length(path):
+  pos = 0
+  with open(path,'rb') as f:
+    while True:
+      header = f.read(HEADER.size)
+      if len(header)<HEADER.size: return pos
+      n,crc,_ = HEADER.unpack(header)
+      payload = f.read(n)
+      if len(payload)<n or zlib.crc32(payload)!=crc: return pos
+      pos += HEADER.size + n
+
+
+# Open (or create) the log [q] under the directory [root]
+def create(root,q,segment_bytes=64*_1MB):
+  return Segments(root,q,segment_bytes)
+
+# Remove all the records of the logs
+def purge(feeder):
+  feeder.close()
+  for base in feeder.bases(): os.remove(feeder.path_of(base))
+  path = os.path.join(feeder.dir,'offsets.json')
+  if os.path.isfile(path): os.remove(path)
+
+# Serialise the record into a payload and its kind
+def encode(record,no_parse=False):
+  if isinstance(record,np.ndarray) and not record.dtype.hasobject:
+    return pack_array(record),ARRAY
+  if not isinstance(record,str) and not no_parse:
+    if isinstance(record,np.ndarray): record = record.tolist()
+    record = json.dumps(record,ensure_ascii=False)
+  if isinstance(record,str): record = record.encode('utf-8')
+  return record,TEXT
+
+def decode(buf,kind):
+  if kind==ARRAY: return unpack_array(buf)
+  return str(buf,'utf-8')
+
+# @param {list} of logs
+# @param {int} batch_size, records buffered before writing out (0: at once)
+# @return {Record} it remains unchanged
+def feed(feeders,batch_size=0,confirm=False):
+  buffered = [0]
+
+  def flush():
+    for feeder in feeders: feeder.flush()
+    buffered[0] = 0
+
+  def feed_message(record,no_parse=False):
+    payload,kind = encode(record,no_parse)
+    for feeder in feeders: feeder.append(payload,kind)
+    buffered[0] += 1
+    if buffered[0]>=max(1,batch_size): flush()
+    return record
+
+  def feed_messages(records):
+    for r in records: feed_message(r)
+    return records
+
+  feed_message.batch      = feed_messages
+  feed_message.flush      = flush
+  feed_message.threadsafe = False # A log has a single writer
+  return feed_message
+
+# Record generator
+# @param {Segments} feeder, the log to read
+# @param {Function} transformation of each record
+# @param {float} timeout, seconds without any new record until the iteration ends (None: never)
+# @param {int} chunk, yield lists of up to [chunk] records (optional)
+# @param {float} linger, longest wait for a chunk to fill up (seconds, optional)
+# @param {Function} until, the iteration ends once it returns True (optional)
+# @param {int} offset to read from (default: committed offset of [group], or the beginning)
+# @param {str} group, name of the reader whose offset is committed at the end (optional)
+#
+# [prefetch], [ack_every] and [ack_interval] are taken for the
+# parity with rabbit.iter, a log has nothing to acknowledge.
+# As the messages acknowledged by rabbit.iter, a record (or chunk)
+# counts as read once the next one is requested; the committed
+# offset is right after it, the one at hand is read again.
+def iter(feeder,transformation=lambda x:x,timeout=0,prefetch=None,ack_every=None,ack_interval=None,
+  chunk=None,linger=None,until=None,offset=None,group=None):
+  if offset is None:
+    offset = feeder.offsets().get(group,0) if group else 0
+  feeder.flush()
+
+  read,batch,started = offset,[],0 # [read]: position of the next record
+  idle_since = time.time()
+  try:
+    while True:
+      moved = False
+      for pos,buf,kind in __records(feeder,read):
+        msg = transformation(decode(buf,kind))
+        read,moved = pos,True
+        if not chunk:
+          yield msg
+          offset = pos
+        else:
+          if len(batch)==0: started = time.time()
+          batch.append(msg)
+          if len(batch)>=chunk:
+            yield batch
+            batch,offset = [],pos
+        if until is not None and until(): return
+
+      now = time.time()
+      if moved: idle_since = now
+      idle = timeout is not None and now-idle_since>=timeout
+      if chunk and len(batch)>0 and (idle or (linger is not None and now-started>=linger)):
+        yield batch
+        batch,offset = [],read
+      if idle or (until is not None and until()): return
+      time.sleep(min(t for t in (0.2,timeout,linger) if t is not None))
+  finally:
+    if group: feeder.commit(group,offset)
+
+# The complete records from [offset] on, as
+# (offset after the record, payload buffer, kind)
+def __records(feeder,offset):
+  bases = feeder.bases()
+  for i,base in enumerate(bases):
+    end = bases[i+1] if i+1<len(bases) else None
+    if end is not None and end<=offset: continue
+    path = feeder.path_of(base)
+    size = os.path.getsize(path)
+    if size==0: continue
+    with open(path,'rb') as f:
+      mm = mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+    pos = max(0,offset-base)
+    while pos+HEADER.size<=size:
+      n,crc,kind = HEADER.unpack_from(view,pos)
+      start = pos + HEADER.size
+      if start+n>size or zlib.crc32(view[start:start+n])!=crc: break # Torn or still being written
+      pos = start + n
+      yield base+pos,view[start:start+n],kind
+
+def end(feeder):
+  print(colored('Ending log #','white'),feeder.q)
+  feeder.close()
+
+def end_multiple(feeders):
+  [end(f) for f in feeders]
@@ -9,6 +9,7 @@ import os.path
 import pickle
 import json
 from termcolor import colored
+from .. import memtrack
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import Normalizer
@@ -62,6 +63,7 @@ def hash(operations,learn=False):
       for i in range(len(operations)):
         print('Processing #{0} : {1}'.format(i,type(operations[i])))
         x = operations[i].fit_transform(x)
+        memtrack.note(type(operations[i]).__name__,x)
     else:
       for i in range(len(operations)): 
         x = operations[i].transform(x)
@@ -11,6 +11,7 @@ import math
 import sys
 from .sparsetodense import SparseToDense
 from termcolor import colored
+from .. import memtrack
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.feature_selection import SelectKBest, chi2
 from sklearn.neighbors import NearestCentroid
@@ -41,7 +42,7 @@ def new(stop_words=[],decomposition='SVD',n_components=5):
   if decomposition and n_components:
     if decomposition=='LDA': # Results in Non-negative matrix
       reducer = LatentDirichletAllocation( # TFIDF --> Topic term
-        n_topics=n_components,
+        n_components=n_components,
         max_doc_update_iter=20,
         max_iter=8  
       )
@@ -152,6 +153,7 @@ def hash(operations,learn=False):
       for i in range(len(operations)): 
         print('Processing ... #{0} : {1}'.format(i,type(operations[i])))
         x = operations[i].fit_transform(x)
+        memtrack.note(type(operations[i]).__name__,x)
     else:
       for i in range(len(operations)): 
         x = operations[i].transform(x)
@@ -0,0 +1,113 @@
+"""
+Tokenisation result cache
+---------------------------
+Two-level memo of the tokenised texts: an in-process LRU
+bounded by its memory footprint, backed by an optional
+on-disk store. Entries are keyed by the content hash of the
+text along with the tokeniser version, so upgrading the
+tokeniser never serves stale results. Nothing is cached
+while the version is unknown (None).
+
+@starcolon projects
+"""
+
+from collections import OrderedDict
+import threading
+import hashlib
+import json
+import dbm
+
+_1MB = 1048576
+
+class TokenCache(object):
+  # @param {str|Function} tokeniser version
+  def __init__(self,version,max_bytes=64*_1MB,path=None):
+    self.version   = version
+    self.max_bytes = max_bytes
+    self.lru       = OrderedDict() # key => (words, size)
+    self.size      = 0
+    self.disk      = dbm.open(path,'c') if path else None
+    self.lock      = threading.Lock()
+    self.hits      = {'memory': 0, 'disk': 0}
+    self.misses    = 0
+    self.fresh     = None # Newly put entries, once detached
+
+  # @return {str} or None if the tokeniser version is unknown
+  def key(self,text):
+    version = self.version() if callable(self.version) else self.version
+    if version is None: return None
+    data = '{0}\0{1}'.format(version,text).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+  # @return {list} of words or None if the text is not cached
+  def get(self,text):
+    k = self.key(text)
+    with self.lock:
+      if k is None:
+        self.misses += 1
+        return None
+      if k in self.lru:
+        self.lru.move_to_end(k)
+        self.hits['memory'] += 1
+        return self.lru[k][0]
+
+      if self.disk is not None:
+        value = self.disk.get(k)
+        if value is not None:
+          words = json.loads(value.decode('utf-8'))
+          self.__remember(k,words,len(value))
+          self.hits['disk'] += 1
+          return words
+
+      self.misses += 1
+      return None
+
+  def put(self,text,words):
+    k = self.key(text)
+    if k is None: return
+    value = json.dumps(words,ensure_ascii=False).encode('utf-8')
+    with self.lock:
+      self.__remember(k,words,len(value))
+      if self.disk is not None: self.disk[k] = value
+      if self.fresh is not None: self.fresh.append((text,words))
+
+  def __remember(self,k,words,size):
+    if k in self.lru:
+      self.size -= self.lru.pop(k)[1]
+    self.lru[k] = (words,size)
+    self.size  += size
+    # Evict the least recently used texts
+    while self.size>self.max_bytes and len(self.lru)>1:
+      _,(_,s) = self.lru.popitem(last=False)
+      self.size -= s
+
+  # Detach the cache in a forked process: the on-disk store
+  # is left to the parent (it is never closed nor written here)
+  # and the newly put entries are kept for the parent to merge
+  def detach(self):
+    self.lock     = threading.Lock()
+    self.inherited,self.disk = self.disk,None
+    self.fresh    = []
+
+  # @return {list} of (text, words) put since the last call
+  def drain(self):
+    with self.lock:
+      fresh,self.fresh = self.fresh,[]
+    return fresh
+
+  def stats(self):
+    lookups = self.hits['memory'] + self.hits['disk'] + self.misses
+    return {
+      'memory_hits': self.hits['memory'],
+      'disk_hits':   self.hits['disk'],
+      'misses':      self.misses,
+      'hit_rate':    (lookups-self.misses)/lookups if lookups else 0.0,
+      'entries':     len(self.lru),
+      'bytes':       self.size
+    }
+
+  def close(self):
+    with self.lock:
+      if self.disk is not None:
+        self.disk.close()
+        self.disk = None
@@ -2,12 +2,274 @@
 String tokeniser operation
 @starcolon projects
 """
-from tornado import httpclient
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit
 from termcolor import colored
+import http.client
+import asyncio
+import threading
+import queue
 import json
+import time
+import os
+
+REPO_DIR = os.getenv('PANTIPLIBR','.')
 
 tokeniser_serv = 'http://localhost:9861/break/'
 
+# Tokeniser backend:
+# [http]   : tokenizer.rb service(s)
+# [python] : in-process word breaker over the compiled dictionary
+BACKEND   = os.getenv('TOKENIZER_BACKEND','http')
+DICT_PATH = os.getenv('TOKENIZER_DICT','{0}/data/words/dict.trie'.format(REPO_DIR))
+
+# Tokeniser service endpoint with its own pool
+# of persistent connections
+class Endpoint(object):
+  def __init__(self,url,pool_size=4):
+    target           = urlsplit(url)
+    self.url         = url
+    self.host        = target.netloc
+    self.path        = target.path
+    self.idle        = queue.LifoQueue(maxsize=pool_size)
+    self.outstanding = 0 # Number of in-flight requests
+    self.down_until  = 0 # Skipped until then after a failure
+
+  def __connect(self):
+    return http.client.HTTPConnection(self.host,timeout=60)
+
+  # Version of the tokeniser service
+  def version(self):
+    conn = http.client.HTTPConnection(self.host,timeout=2)
+    try:
+      conn.request('GET','/version/')
+      resp = conn.getresponse()
+      output = resp.read()
+    finally:
+      conn.close()
+    if resp.status!=200:
+      raise IOError('HTTP {0} : {1}'.format(resp.status,output[:200]))
+    return output.decode('utf-8').strip()
+
+  def __acquire(self):
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      return self.__connect()
+
+  def __release(self,conn):
+    try:
+      self.idle.put_nowait(conn)
+    except queue.Full:
+      conn.close()
+
+  def post(self,body):
+    conn = self.__acquire()
+    try:
+      try:
+        conn.request('POST',self.path,body=body)
+        resp = conn.getresponse()
+      except (http.client.HTTPException,OSError):
+        # Stale keep-alive connection, retry over a fresh one
+        conn.close()
+        conn = self.__connect()
+        conn.request('POST',self.path,body=body)
+        resp = conn.getresponse()
+      output = resp.read()
+    except Exception:
+      conn.close()
+      raise
+
+    if resp.will_close: conn.close()
+    else: self.__release(conn)
+    if resp.status!=200:
+      raise IOError('HTTP {0} : {1}'.format(resp.status,output[:200]))
+    return output
+
+
+# Tokeniser service client which keeps pools of
+# persistent connections and coalesces the texts
+# submitted by concurrent callers into batched requests.
+# Requests go to the endpoint with the least outstanding requests.
+class Client(object):
+  def __init__(self,urls=[tokeniser_serv],pool_size=4,batch_size=64,linger=0.005):
+    self.endpoints  = [Endpoint(u,pool_size) for u in urls]
+    self.pool_size  = pool_size
+    self.batch_size = batch_size
+    self.linger     = linger # seconds to wait for more texts to batch
+    self.pending    = queue.Queue()
+    self.worker     = None
+    self.lock       = threading.Lock()
+    self.senders    = ThreadPoolExecutor(max_workers=pool_size*len(urls))
+    self.version    = None # As reported by the services
+
+  # A new client with the same settings, e.g. in a forked process
+  # where the background threads of this one do not exist
+  def clone(self):
+    urls = [e.url for e in self.endpoints]
+    client = Client(urls,self.pool_size,self.batch_size,self.linger)
+    client.version = self.version
+    return client
+
+  # Version of the tokeniser services, asked once
+  # @return {str} or None while none of them answers
+  def service_version(self):
+    if self.version is not None: return self.version
+    for endpoint in self.endpoints:
+      try:
+        self.version = endpoint.version()
+        return self.version
+      except (http.client.HTTPException,OSError):
+        continue
+    return None
+
+  # Pick the least busy endpoint which is not known to be down
+  def __pick(self,exclude=None):
+    now = time.time()
+    with self.lock:
+      alive = [e for e in self.endpoints if e.down_until<=now and e is not exclude]
+      endpoint = min(alive or self.endpoints,key=lambda e: e.outstanding)
+      endpoint.outstanding += 1
+    return endpoint
+
+  def __post(self,body):
+    endpoint = self.__pick()
+    try:
+      return endpoint.post(body)
+    except (http.client.HTTPException,OSError):
+      # The worker may be restarting, try another one
+      endpoint.down_until = time.time() + 1
+      if len(self.endpoints)==1: raise
+      retry = self.__pick(exclude=endpoint)
+      try:
+        return retry.post(body)
+      finally:
+        with self.lock: retry.outstanding -= 1
+    finally:
+      with self.lock: endpoint.outstanding -= 1
+
+  # Break the texts into words, in requests of [batch_size] texts
+  # sent side by side (over the least busy endpoints)
+  # @param {list} of string
+  # @return {list} of list of string
+  def break_words(self,texts):
+    return self.__break_slices(texts).result()
+
+  def __break_slice(self,texts):
+    package = {'data': texts}
+    output  = self.__post(json.dumps(package,ensure_ascii=False).encode('utf-8'))
+    return json.loads(output.decode('utf-8'))['data']
+
+  # @return {Future} of the words of all the slices, in order
+  def __break_slices(self,texts):
+    future = Future()
+    parts  = [self.senders.submit(self.__break_slice,texts[i:i+self.batch_size])
+              for i in range(0,len(texts),self.batch_size)]
+    if len(parts)==0:
+      future.set_result([])
+      return future
+
+    # Reassemble once the last slice is back, no sender
+    # thread is held waiting for the others
+    remaining = [len(parts)]
+    def done(_):
+      with self.lock:
+        remaining[0] -= 1
+        if remaining[0]>0: return
+      try:
+        future.set_result([w for part in parts for w in part.result()])
+      except Exception as e:
+        future.set_exception(e)
+    for part in parts: part.add_done_callback(done)
+    return future
+
+  # Queue the texts to be tokenised along with
+  # those of the other callers
+  # @param {list} of string
+  # @return {Future} of list of list of string
+  def submit(self,texts):
+    future = Future()
+    self.pending.put((texts,future))
+    with self.lock:
+      if self.worker is None:
+        self.worker = threading.Thread(target=self.__coalesce,daemon=True)
+        self.worker.start()
+    return future
+
+  def __coalesce(self):
+    while True:
+      batch = [self.pending.get()]
+      size  = len(batch[0][0])
+      deadline = time.time() + self.linger
+      # Keep collecting until the batch is full or the linger expires
+      while size<self.batch_size:
+        try:
+          batch.append(self.pending.get(timeout=max(0,deadline-time.time())))
+          size += len(batch[-1][0])
+        except queue.Empty:
+          break
+
+      # Send the batch while the next one is being collected
+      self.__send(batch)
+
+  def __send(self,batch):
+    sent = self.__break_slices([t for texts,_ in batch for t in texts])
+
+    # Hand each caller back its own share of the results
+    def share(sent):
+      try:
+        words = sent.result()
+      except Exception as e:
+        for _,future in batch: future.set_exception(e)
+        return
+      i = 0
+      for texts,future in batch:
+        future.set_result(words[i:i+len(texts)])
+        i += len(texts)
+    sent.add_done_callback(share)
+
+
+__client  = Client()
+__breaker = None
+
+# Switch the tokeniser backend, [http] or [python]
+def use(backend,dict_path=None):
+  global BACKEND,DICT_PATH,__breaker
+  BACKEND   = backend
+  DICT_PATH = dict_path or DICT_PATH
+  __breaker = None
+
+def breaker():
+  global __breaker
+  if __breaker is None:
+    from .wordbreak import WordBreaker
+    __breaker = WordBreaker(DICT_PATH)
+  return __breaker
+
+# Version of the active tokeniser (dictionary),
+# None while the tokeniser services cannot tell
+def version():
+  if BACKEND=='python': return breaker().version
+  return __client.service_version()
+
+# Replace the default tokeniser client
+# e.g. to spread the requests over a pool of tokenisers
+# @param {list} urls of the tokeniser services
+def configure(**kwargs):
+  global __client
+  __client = Client(**kwargs)
+  __client.service_version()
+  return __client
+
+def client():
+  return __client
+
+def __after_fork():
+  global __client
+  __client = __client.clone()
+
+os.register_at_fork(after_in_child=__after_fork)
+
 # @input: String
 # @output: list of string
 def tokenize(phrase):
@@ -18,31 +280,33 @@ def tokenize(phrase):
   # Generate a tokenising request
   return __request(phrase)
 
+# Tokenise multiple texts through the batching client
+# or the in-process word breaker
+# @param {list} of string
+# @return {list} of list of string
+def tokenize_many(texts):
+  if BACKEND=='python':
+    return [breaker().break_into_words(t) for t in texts]
+  return __client.submit(texts).result()
+
+# Awaitable [tokenize_many], the texts share the batched
+# requests with the other callers while waiting
+async def tokenize_many_async(texts):
+  if BACKEND=='python':
+    return [breaker().break_into_words(t) for t in texts]
+  return await asyncio.wrap_future(__client.submit(texts))
+
 # Make a request to the tokeniser service
 def __request(input0):
-  client = httpclient.HTTPClient()
   output = None
   try:
-    print(colored('tokenising.. ','yellow') + input0)
-    req    = httpclient.HTTPRequest(tokeniser_serv,method='POST',body=input0)
-    resp   = client.fetch(req)
-    output = resp.body
-
-    # Decode bytes
-    output = output.decode('utf-8')
-    # Parse the JSON response to a hash object
-    output = json.loads(output)
-
-  except httpclient.HTTPError as e:
+    texts  = json.loads(input0)['data']
+    output = {'data': tokenize_many(texts)}
+  except (IOError,http.client.HTTPException) as e:
     # HTTP error header
     print(colored('HTTP Error : ' + str(e),'red'))
   except Exception as e:
     # Some unhandled error
     print(colored('ERROR : ' + str(e), 'red'))
 
-  client.close()
-
-  print(colored('{Tokenizer received:}','white'))
-  print(colored(output,'white'))
-
   return output
@@ -0,0 +1,106 @@
+"""
+Tokeniser worker pool
+---------------------------
+Run multiple tokeniser services (tokenizer.rb), each on
+its own port, keep them health-checked through `/version/`
+and restart any of them which dies. The tokeniser client
+spreads the requests over the pool.
+
+@starcolon projects
+"""
+
+from termcolor import colored
+from urllib.request import urlopen
+from . import tokenizer
+import subprocess
+import threading
+import time
+import os
+
+REPO_DIR  = os.getenv('PANTIPLIBR','.')
+SCRIPT    = '{0}/core/tokenizer/tokenizer.rb'.format(REPO_DIR)
+BASE_PORT = 9861
+
+class TokenizerPool(object):
+  def __init__(self,n=None,base_port=BASE_PORT,check_every=5):
+    if n is None: n = int(os.getenv('TOKENIZER_WORKERS',os.cpu_count() or 1))
+    self.ports       = [base_port+i for i in range(n)]
+    self.procs       = {}
+    self.failures    = {} # Consecutive failed health checks
+    self.check_every = check_every
+    self.stopping    = threading.Event()
+    self.monitor     = None
+
+  def urls(self):
+    return ['http://localhost:{0}/break/'.format(p) for p in self.ports]
+
+  def __spawn(self,port):
+    print(colored('🚀 Executing tokeniser on port {0}...'.format(port),'green'))
+    env = dict(os.environ,TOKENIZER_PORT=str(port))
+    self.procs[port] = subprocess.Popen(
+      ['ruby',SCRIPT],
+      env=env,
+      stdout=subprocess.DEVNULL,
+      start_new_session=True
+    )
+
+  def is_healthy(self,port):
+    try:
+      with urlopen('http://localhost:{0}/version/'.format(port),timeout=2) as resp:
+        return resp.status==200
+    except Exception:
+      return False
+
+  # Start all the workers and wait until they serve
+  def start(self,timeout=30):
+    for port in self.ports: self.__spawn(port)
+    deadline = time.time() + timeout
+    waiting  = list(self.ports)
+    while waiting and time.time()<deadline:
+      waiting = [p for p in waiting if not self.is_healthy(p)]
+      if waiting: time.sleep(0.2)
+    if waiting:
+      print(colored('Tokenisers not responding on ports {0}'.format(waiting),'red'))
+
+    self.monitor = threading.Thread(target=self.__watch,daemon=True)
+    self.monitor.start()
+    return self
+
+  # Restart the dead workers, or those unresponsive
+  # for several checks in a row (a busy one may be slow to answer)
+  def __watch(self,max_failures=3):
+    while not self.stopping.wait(self.check_every):
+      for port,proc in list(self.procs.items()):
+        if self.stopping.is_set(): return
+        if proc.poll() is None:
+          if self.is_healthy(port):
+            self.failures[port] = 0
+            continue
+          self.failures[port] = self.failures.get(port,0) + 1
+          if self.failures[port]<max_failures: continue
+        self.failures[port] = 0
+        print(colored('Tokeniser on port {0} is down, restarting...'.format(port),'red'))
+        if proc.poll() is None: proc.kill()
+        proc.wait()
+        self.__spawn(port)
+
+  def end(self):
+    self.stopping.set()
+    print(colored('Ending tokenisers...','green'))
+    for proc in self.procs.values():
+      if proc.poll() is None: proc.terminate()
+    for proc in self.procs.values():
+      proc.wait()
+
+
+# Start a pool of tokenisers and route the
+# tokeniser client requests to it
+# @param {int} number of workers (default: TOKENIZER_WORKERS or number of cores)
+def start(n=None,**kwargs):
+  if tokenizer.BACKEND=='python':
+    print(colored('In-process word breaker, no tokeniser service needed','green'))
+    return TokenizerPool(0)
+
+  pool = TokenizerPool(n).start()
+  tokenizer.configure(urls=pool.urls(),**kwargs)
+  return pool
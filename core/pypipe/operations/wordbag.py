@@ -16,4 +16,25 @@ def feed(bag):
       if len(w)>0:
         if w in bag: bag[w] += 1
         else: bag[w] = 1
-  return _feed
\ No newline at end of file
+
+  def _feed_many(tokenised_recs):
+    for rec in tokenised_recs: _feed(rec)
+    return tokenised_recs
+
+  # Parallel pipe: each worker counts into its own bag,
+  # handed over (and emptied) after every chunk
+  def _collect():
+    counts = dict(bag)
+    bag.clear()
+    return counts
+
+  def _merge(counts):
+    for w,n in counts.items():
+      bag[w] = bag.get(w,0) + n
+
+  _feed.batch      = _feed_many
+  _feed.threadsafe = False
+  _feed.spawn      = (feed,(new(),))
+  _feed.collect    = _collect
+  _feed.merge      = _merge
+  return _feed
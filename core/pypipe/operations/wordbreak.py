@@ -0,0 +1,151 @@
+"""
+In-process Thai word breaker
+---------------------------
+Dictionary-based maximal matching, an alternative
+to the tokenizer.rb service. The dictionary is compiled
+into a compact trie file which is memory-mapped on load:
+
+  header : b'PLTRIE1\\0' + uint32 number of nodes
+  nodes  : uint32 triples of (char, first child, children << 1 | terminal)
+
+Children of each node are stored contiguously, sorted
+by their characters. Node #0 is the root.
+
+To compile a word list (one word per line):
+
+  $ python3 core/pypipe/operations/wordbreak.py words.txt data/words/dict.trie
+
+@starcolon projects
+"""
+
+import hashlib
+import struct
+import mmap
+import sys
+import re
+import os
+
+MAGIC = b'PLTRIE1\0'
+
+# Runs of Thai characters, whitespaces, or anything else
+RUNS = re.compile(r'([฀-๿]+|\s+|[^฀-๿\s]+)')
+THAI = re.compile(r'[฀-๿]')
+
+# Compile the word list into a trie file
+# @param {iterable} of words
+# @param {str} path of the trie file
+def compile_words(words,path):
+  root = {}
+  for w in words:
+    w = w.strip()
+    if len(w)==0: continue
+    node = root
+    for c in w: node = node.setdefault(c,{})
+    node[''] = True # Terminal mark
+
+  # Breadth-first layout keeps the children contiguous
+  nodes = [[0,0,0]]
+  queue = [(root,0)]
+  while queue:
+    nextq = []
+    for trie,i in queue:
+      chars = sorted(c for c in trie if c!='')
+      nodes[i][1] = len(nodes)
+      nodes[i][2] = (len(chars) << 1) | (1 if '' in trie else 0)
+      for c in chars:
+        nextq.append((trie[c],len(nodes)))
+        nodes.append([ord(c),0,0])
+    queue = nextq
+
+  with open(path,'wb') as f:
+    f.write(MAGIC + struct.pack('<I',len(nodes)))
+    f.write(struct.pack('<{0}I'.format(3*len(nodes)),*[v for n in nodes for v in n]))
+
+def compile_file(src,path):
+  with open(src,encoding='utf-8') as f:
+    compile_words(f,path)
+
+
+class WordBreaker(object):
+  def __init__(self,path):
+    with open(path,'rb') as f:
+      self.mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+    if self.mm[:8]!=MAGIC:
+      raise ValueError('Not a compiled dictionary : {0}'.format(path))
+    n = struct.unpack('<I',self.mm[8:12])[0]
+    self.nodes   = memoryview(self.mm)[12:12+12*n].cast('I')
+    self.version = 'py-' + hashlib.sha1(self.mm).hexdigest()[:12]
+
+  # Find the child of the node by its character
+  def __child(self,node,c):
+    nodes = self.nodes
+    lo = nodes[3*node+1]
+    hi = lo + (nodes[3*node+2] >> 1)
+    while lo<hi:
+      mid = (lo+hi) >> 1
+      ch  = nodes[3*mid]
+      if ch==c: return mid
+      if ch<c: lo = mid+1
+      else: hi = mid
+    return -1
+
+  # @return {list} of end positions of the dictionary words
+  # starting at position [i] of the text
+  def prefixes(self,text,i):
+    ends = []
+    node = 0
+    for j in range(i,len(text)):
+      node = self.__child(node,ord(text[j]))
+      if node<0: break
+      if self.nodes[3*node+2] & 1: ends.append(j+1)
+    return ends
+
+  # Break the Thai text into the path of
+  # fewest unknown characters, then fewest words
+  def __break_thai(self,text):
+    n    = len(text)
+    best = [None]*(n+1) # (unknowns, words, previous position, known?)
+    best[0] = (0,0,-1,True)
+    for i in range(n):
+      if best[i] is None: continue
+      u,w,_,_ = best[i]
+      for j in self.prefixes(text,i):
+        if best[j] is None or (u,w+1)<best[j][:2]:
+          best[j] = (u,w+1,i,True)
+      # Skip an unknown character
+      if best[i+1] is None or (u+1,w+1)<best[i+1][:2]:
+        best[i+1] = (u+1,w+1,i,False)
+
+    # Walk back the path, merging the consecutive unknown characters
+    words = []
+    j = n
+    while j>0:
+      _,_,i,known = best[j]
+      if not known and words and words[-1][1]==False and words[-1][2]==j:
+        words[-1] = (text[i:j] + words[-1][0],False,i)
+      else:
+        words.append((text[i:j],known,i))
+      j = i
+    return [w for w,_,_ in reversed(words)]
+
+  # @param {str} text
+  # @return {list} of words
+  def break_into_words(self,text):
+    words = []
+    for run in RUNS.findall(text):
+      if THAI.match(run): words += self.__break_thai(run)
+      else: words.append(run)
+    return words
+
+  def close(self):
+    self.nodes.release()
+    self.mm.close()
+
+
+if __name__ == '__main__':
+  if len(sys.argv)<3:
+    print('Usage: wordbreak.py <word list> <trie file>')
+    sys.exit(1)
+  compile_file(sys.argv[1],sys.argv[2])
+  print('Compiled {0} => {1} ({2} bytes)'.format(
+    sys.argv[1],sys.argv[2],os.path.getsize(sys.argv[2])))
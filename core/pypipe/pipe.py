@@ -7,6 +7,15 @@ Generic record processing pipeline.
 import pyspark
 from termcolor import colored
 from functools import reduce
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from . import metrics
+from . import profiling
+import multiprocessing
+import threading
+import asyncio
+import time
 
 
 class Pipe:
@@ -17,6 +26,25 @@ class Pipe:
       '{0} finished processing.'.format(title))
 
 
+# Names of the tasks as reported by the stage metrics
+def stage_names(pipe):
+  return ['{0}/{1}.{2}'.format(pipe.title,i,getattr(t,'__name__','task'))
+    for i,t in enumerate(pipe.tasks)]
+
+# The task wrapped with the metrics and the profiler, if they are on
+def instrument(name,task):
+  return metrics.wrap_task(name,profiling.wrap_task(name,task))
+
+# The tasks of the pipe, instrumented if the metrics
+# or the profiling are on
+def tasks_of(pipe):
+  if not (metrics.enabled or profiling.enabled): return pipe.tasks
+  key = (metrics.generation,profiling.generation,len(pipe.tasks))
+  if getattr(pipe,'instrumented',(None,))[0]!=key:
+    tasks = [instrument(n,t) for n,t in zip(stage_names(pipe),pipe.tasks)]
+    pipe.instrumented = (key,tasks)
+  return pipe.instrumented[1]
+
 # Create a task pipeline
 def new(title,tasks):
   return Pipe(title,tasks)
@@ -50,7 +78,7 @@ def operate(pipe,input0):
   def take(a,task):
     return task(a)
 
-  out = reduce(take,pipe.tasks,input0)
+  out = reduce(take,tasks_of(pipe),input0)
 
   # Send the output via callback
   if pipe.then is not None: 
@@ -59,4 +87,273 @@ def operate(pipe,input0):
   else:
     print('[Then] is not supplied.')
 
+# Split the iterable input into chunks of [chunk_size] records
+# @param {float} linger, longest wait for a chunk to fill up (seconds, optional),
+#                the input is then read in background so a slow
+#                (e.g. followed) source never holds a chunk back
+def chunks(inputs,chunk_size,linger=None):
+  if linger is not None:
+    yield from __linger_chunks(inputs,chunk_size,linger)
+    return
+
+  chunk = []
+  for a in inputs:
+    chunk.append(a)
+    if len(chunk)>=chunk_size:
+      yield chunk
+      chunk = []
+  if len(chunk)>0: yield chunk
+
+def __linger_chunks(inputs,chunk_size,linger):
+  q    = Queue(maxsize=2*chunk_size)
+  done = object()
+  def produce():
+    try:
+      for a in inputs: q.put((a,None))
+      q.put((done,None))
+    except Exception as e:
+      q.put((done,e))
+  threading.Thread(target=produce,daemon=True).start()
+
+  while True:
+    # A chunk starts with its first record, however long it takes
+    a,error = q.get()
+    if a is done: break
+    chunk    = [a]
+    deadline = time.time() + linger
+    while len(chunk)<chunk_size:
+      try:
+        a,error = q.get(timeout=max(0,deadline-time.time()))
+      except Empty:
+        break
+      if a is done: break
+      chunk.append(a)
+    yield chunk
+    if a is done: break
+
+  if error is not None: raise error
+
+def __take_chunk(a,task):
+  if hasattr(task,'batch'): return task.batch(a)
+  return [task(r) for r in a]
+
+# Execute the pipeline over a chunk (list) of records.
+# A task which declares the attribute [batch] (a function
+# taking a list of records) processes the whole chunk at once,
+# the others are applied record by record.
+# The callback [then] receives the list of outputs.
+def operate_chunk(pipe,chunk):
+  if pipe is None:
+    raise ValueError('Pipe is not available')
+
+  out = reduce(__take_chunk,tasks_of(pipe),chunk)
+
+  if pipe.then is not None:
+    pipe.result = out
+    pipe.then(out)
+  return out
+
+# Execute the pipeline over the input records in chunks
+# @param {Iterable} inputs
+# @param {int} chunk_size
+# @return {int} number of records processed
+def operate_batch(pipe,inputs,chunk_size=100):
+  print(colored('⏳ Executing {0} in chunks of {1}...'.format(pipe.title,chunk_size),'green'))
+  n = 0
+  for chunk in chunks(inputs,chunk_size):
+    operate_chunk(pipe,chunk)
+    n += len(chunk)
+  return n
+
+
+# ------------------------------------
+# Parallel execution over a process pool
+# ------------------------------------
+# A task runs inside the pool workers if it is a module-level
+# function, or if it declares how to rebuild itself there:
+#
+#   task.spawn   = (factory, args)  # picklable, worker calls factory(*args) once
+#   task.collect = function()       # (worker copy) state accumulated since the last call
+#   task.merge   = function(state)  # (parent copy) merges the state from a worker
+#
+# The leading tasks which can run in the workers do so,
+# the rest of the pipe runs in the parent process over
+# the results streamed back from the workers.
+
+__worker_tasks = []
+__worker_names = []
+
+def __same(task):
+  return task
+
+def __can_spawn(task):
+  if hasattr(task,'spawn'): return True
+  qualname = getattr(task,'__qualname__','<locals>')
+  return '<locals>' not in qualname and '<lambda>' not in qualname
+
+def __init_worker(recipes,names):
+  global __worker_tasks,__worker_names
+  __worker_names = names
+  __worker_tasks = [factory(*args) for factory,args in recipes]
+  # The metrics switch is inherited by the forked worker,
+  # the stats so far are the parent's own
+  metrics.reset()
+  __worker_tasks = [instrument(n,t) for n,t in zip(names,__worker_tasks)]
+  if profiling.enabled:
+    multiprocessing.util.Finalize(None,profiling.save,exitpriority=5)
+  # Release the worker resources (e.g. connections) on exit
+  for task in __worker_tasks:
+    if hasattr(task,'close'):
+      multiprocessing.util.Finalize(None,task.close,exitpriority=10)
+
+def __work(chunk,submitted=None):
+  if metrics.enabled and submitted:
+    metrics.wait(__worker_names[0],time.time()-submitted)
+  out    = reduce(__take_chunk,__worker_tasks,chunk)
+  states = [t.collect() if hasattr(t,'collect') else None for t in __worker_tasks]
+  return out,states,(metrics.drain() if metrics.enabled else None)
+
+# Execute the pipeline over the input records across a pool of processes
+# @param {Iterable} inputs
+# @param {int} workers (default: number of cores)
+# @param {bool} ordered, whether the outputs keep the order of the inputs
+# @param {int} chunk_size, number of records sent to a worker at once
+# @return {int} number of records processed
+def operate_parallel(pipe,inputs,workers=None,ordered=True,chunk_size=100):
+  if pipe is None:
+    raise ValueError('Pipe is not available')
+
+  k = 0
+  while k<len(pipe.tasks) and __can_spawn(pipe.tasks[k]): k += 1
+  remote,local = pipe.tasks[:k],tasks_of(pipe)[k:]
+  if k==0:
+    print(colored('{0} has no task to run in parallel'.format(pipe.title),'yellow'))
+    return operate_batch(pipe,inputs,chunk_size)
+
+  workers = workers or multiprocessing.cpu_count()
+  print(colored('⏳ Executing {0} over {1} processes ({2} of {3} tasks in parallel)...'.format(
+    pipe.title,workers,k,len(pipe.tasks)),'green'))
+
+  recipes = [t.spawn if hasattr(t,'spawn') else (__same,(t,)) for t in remote]
+  # Workers are forked so they inherit the loaded models
+  context = multiprocessing.get_context('fork')
+  names   = stage_names(pipe)[:k]
+  pool    = context.Pool(workers,initializer=__init_worker,initargs=(recipes,names))
+
+  n = 0
+  def finish(result):
+    nonlocal n
+    if isinstance(result,BaseException): raise result
+    out,states,stats = result
+    for task,state in zip(remote,states):
+      if state is not None: task.merge(state)
+    if stats: metrics.merge(stats)
+    out = reduce(__take_chunk,local,out)
+    n  += len(out)
+    if pipe.then is not None:
+      pipe.result = out
+      pipe.then(out)
+
+  # Only a few chunks per worker are in flight
+  # so a large input is not read ahead entirely
+  max_pending = 2*workers
+  pending     = deque()
+  done        = Queue()
+  callbacks   = {} if ordered else {'callback': done.put, 'error_callback': done.put}
+  def wait_one():
+    if ordered: return pending.popleft().get()
+    pending.pop()
+    return done.get()
+
+  try:
+    for chunk in chunks(inputs,chunk_size):
+      pending.append(pool.apply_async(__work,(chunk,time.time()),**callbacks))
+      while len(pending)>=max_pending: finish(wait_one())
+    while len(pending)>0: finish(wait_one())
+    pool.close()
+  except BaseException:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return n
+
+
+# ------------------------------------
+# Asynchronous execution
+# ------------------------------------
+# Tasks may be coroutine functions, or declare a coroutine
+# variant as [task.aio]. Other tasks run in a thread executor;
+# those declaring [task.threadsafe = False] each run on their
+# own single thread so their calls never overlap.
+
+__END = object() # End of the input
+
+def __async_runner(task,loop,executor):
+  if asyncio.iscoroutinefunction(task): return task
+  if hasattr(task,'aio'): return task.aio
+  if getattr(task,'threadsafe',True) is False:
+    executor = ThreadPoolExecutor(max_workers=1)
+  async def run(a):
+    return await loop.run_in_executor(executor,task,a)
+  run.executor = executor
+  return run
+
+# Execute the pipeline over the input records, with up to
+# [concurrency] records in flight at once. The input is read
+# only as fast as the records are processed.
+# @param {Iterable|AsyncIterable} inputs
+# @param {int} concurrency
+# @param {Executor} executor for the synchronous tasks (optional)
+# @return {int} number of records processed
+async def operate_async(pipe,inputs,concurrency=16,executor=None):
+  if pipe is None:
+    raise ValueError('Pipe is not available')
+  print(colored('⏳ Executing {0} with {1} records in flight...'.format(pipe.title,concurrency),'green'))
+
+  loop    = asyncio.get_running_loop()
+  runners = [__async_runner(t,loop,executor) for t in tasks_of(pipe)]
+  first   = stage_names(pipe)[0] if len(pipe.tasks)>0 else pipe.title
+  pending = asyncio.Queue(maxsize=concurrency)
+  n       = 0
+
+  async def process():
+    nonlocal n
+    while True:
+      a,queued = await pending.get()
+      try:
+        if a is __END: return
+        if metrics.enabled: metrics.wait(first,time.perf_counter()-queued)
+        for run in runners: a = await run(a)
+        n += 1
+        if pipe.then is not None:
+          pipe.result = a
+          pipe.then(a)
+      finally:
+        pending.task_done()
+
+  async def produce():
+    if hasattr(inputs,'__aiter__'):
+      async for a in inputs: await pending.put((a,time.perf_counter()))
+    else:
+      # Reading the input may block (e.g. database pages)
+      it = iter(inputs)
+      while True:
+        a = await loop.run_in_executor(executor,next,it,__END)
+        if a is __END: break
+        await pending.put((a,time.perf_counter()))
+    for _ in range(concurrency): await pending.put((__END,None))
+
+  workers = [asyncio.ensure_future(produce())]
+  workers += [asyncio.ensure_future(process()) for _ in range(concurrency)]
+  try:
+    await asyncio.gather(*workers)
+  finally:
+    for w in workers: w.cancel()
+    for run in runners:
+      if getattr(run,'executor',None) not in (None,executor): run.executor.shutdown(wait=False)
+  return n
 
+# Run [operate_async] to completion from synchronous code
+def operate_concurrent(pipe,inputs,concurrency=16,executor=None):
+  return asyncio.run(operate_async(pipe,inputs,concurrency,executor))
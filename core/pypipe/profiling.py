@@ -0,0 +1,171 @@
+"""
+Pipeline stage profiling
+---------------------------
+Opt-in profiling of the named stages. Each stage gets its own
+deterministic profile (cProfile, readable with pstats or snakeviz),
+while a sampler attributes the stacks of the running stages into
+a collapsed-stack file for flamegraph tools:
+
+  <dir>/<stage>.prof      cProfile stats of the stage
+  <dir>/<stage>.folded    sampled stacks of the stage
+  <dir>/stacks.folded     sampled stacks of all stages
+
+  PYPIPE_PROFILE=dir           enable, write the profiles into [dir]
+  PYPIPE_PROFILE_MODE=sample   sampling only (no cProfile overhead)
+
+Pool workers write theirs with their pid in the file names.
+Coroutine tasks are not profiled, only the sync ones.
+
+@starcolon projects
+"""
+
+from collections import Counter
+from termcolor import colored
+import contextlib
+import threading
+import functools
+import cProfile
+import pstats
+import asyncio
+import atexit
+import sys
+import re
+import os
+
+enabled    = False
+generation = 0
+mode       = 'cprofile' # or [sample]
+outdir     = None
+interval   = 0.005 # seconds between the samples
+__owner    = None # pid which enabled the profiling
+__profiles = {} # (stage, thread id) => cProfile.Profile
+__stacks   = Counter() # collapsed stack => samples
+__active   = {} # thread id => running stage
+__local    = threading.local()
+__lock     = threading.Lock()
+__stopping = threading.Event()
+
+# Turn the profiling on
+# @param {str} dir, where the profiles are written on exit
+# @param {str} mode, [cprofile] (with sampling) or [sample] only
+def enable(dir,mode_='cprofile',interval_=0.005):
+  global enabled,generation,mode,outdir,interval,__owner
+  os.makedirs(dir,exist_ok=True)
+  enabled,mode,outdir,interval = True,mode_,dir,interval_
+  generation += 1
+  if __owner is None:
+    __start_sampler()
+    atexit.register(save)
+  __owner = os.getpid()
+  print(colored('Profiling stages ({0}) into {1}'.format(mode,dir),'yellow'))
+
+def __start_sampler():
+  __stopping.clear()
+  threading.Thread(target=__sample,daemon=True).start()
+
+def __sample():
+  me = threading.get_ident()
+  while not __stopping.wait(interval):
+    frames = sys._current_frames()
+    for tid,name in list(__active.items()):
+      f = frames.get(tid)
+      if f is None or tid==me: continue
+      stack = []
+      while f is not None:
+        code = f.f_code
+        stack.append('{0} ({1}:{2})'.format(code.co_name,os.path.basename(code.co_filename),code.co_firstlineno))
+        f = f.f_back
+      with __lock:
+        __stacks[name + ';' + ';'.join(reversed(stack))] += 1
+
+# Profile the enclosed block as the stage [name]
+@contextlib.contextmanager
+def stage(name):
+  if not enabled:
+    yield
+    return
+
+  tid      = threading.get_ident()
+  outer    = __active.get(tid)
+  __active[tid] = name
+  # cProfile does not nest, the outermost stage takes it all
+  prof = None
+  if mode=='cprofile' and not getattr(__local,'profiling',False):
+    # A profiler is only ever enabled in one thread
+    with __lock:
+      prof = __profiles.setdefault((name,tid),cProfile.Profile())
+    __local.profiling = True
+    prof.enable()
+  try:
+    yield
+  finally:
+    if prof is not None:
+      prof.disable()
+      __local.profiling = False
+    if outer is None: del __active[tid]
+    else: __active[tid] = outer
+
+# Wrap the stage function with the profiler
+# (the function itself if the profiling is off)
+def wrap(name,fn):
+  if not enabled or asyncio.iscoroutinefunction(fn): return fn
+  @functools.wraps(fn)
+  def profiled(*args,**kwargs):
+    with stage(name):
+      return fn(*args,**kwargs)
+  return profiled
+
+# Wrap the pipe task along with its batch variant
+def wrap_task(name,task):
+  if not enabled: return task
+  profiled = wrap(name,task)
+  if hasattr(task,'batch'): profiled.batch = wrap(name,task.batch)
+  return profiled
+
+def __filename(name):
+  return re.sub(r'[^\w.-]+','_',name).strip('_') or 'stage'
+
+# Write the profiles collected so far
+def save():
+  if not enabled: return
+  suffix = '' if os.getpid()==__owner else '.{0}'.format(os.getpid())
+  with __lock:
+    profiles = dict(__profiles)
+    stacks   = Counter(__stacks)
+
+  merged = {}
+  for (name,_),prof in profiles.items():
+    if name in merged: merged[name].add(prof)
+    else: merged[name] = pstats.Stats(prof)
+  for name,stats in merged.items():
+    stats.dump_stats(os.path.join(outdir,__filename(name) + suffix + '.prof'))
+
+  per_stage = {}
+  for key,n in stacks.items():
+    per_stage.setdefault(key.split(';',1)[0],[]).append((key,n))
+  for name,lines in per_stage.items():
+    __write_folded(os.path.join(outdir,__filename(name) + suffix + '.folded'),lines)
+  __write_folded(os.path.join(outdir,'stacks' + suffix + '.folded'),stacks.items())
+
+  if suffix=='':
+    print(colored('Stage profiles written to {0}'.format(outdir),'green'))
+
+def __write_folded(path,lines):
+  with open(path,'w') as f:
+    for key,n in sorted(lines):
+      f.write('{0} {1}\n'.format(key,n))
+
+# A forked process starts over with its own profiles
+def __after_fork():
+  global __profiles,__stacks,__active,__lock
+  if not enabled: return
+  __profiles,__stacks,__active = {},Counter(),{}
+  __lock = threading.Lock()
+  __local.profiling = False
+  __start_sampler()
+
+os.register_at_fork(after_in_child=__after_fork)
+
+
+if os.getenv('PYPIPE_PROFILE'):
+  enable(os.getenv('PYPIPE_PROFILE'),os.getenv('PYPIPE_PROFILE_MODE','cprofile'))
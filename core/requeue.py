@@ -7,26 +7,36 @@ from pypipe import pipe as Pipe
 from pypipe.operations import rabbit
 import json
 
+BATCH = 500 # Messages published at once
+
 if __name__ == '__main__':
   qsrc = rabbit.create('localhost','pantip-x0')
-  qdst = [rabbit.create('localhost',q) for q in ['pantip-x1','pantip-x2','pantip-x3','pantip-x00']]
+  # The exchange copies each message to all the destination queues
+  qdst = rabbit.create_exchange('localhost','pantip-requeue',
+    ['pantip-x1','pantip-x2','pantip-x3','pantip-x00'])
 
   # Requeue!
   print('Requeuing ...')
-  for m in rabbit.iter(qsrc):
-    rabbit.feed(qdst)(m)  
+  # A chunk is acknowledged when the next one is requested,
+  # so it is published before then
+  feed = rabbit.feed([qdst],BATCH)
+  for chunk in rabbit.iter(qsrc,chunk=BATCH):
+    feed.batch(chunk)
+    feed.flush()
   
   # Bye all queues!
-  rabbit.end_multiple(qdst)
+  rabbit.end(qdst)
   rabbit.end(qsrc)
 
   # Transfer from temp MQ#00 to MQ#0
   q00 = rabbit.create('localhost','pantip-x00')
   q0 = rabbit.create('localhost','pantip-x0')
-  for m in rabbit.iter(q00):
-    rabbit.feed([q0])(m)
+  feed = rabbit.feed([q0],BATCH)
+  for chunk in rabbit.iter(q00,chunk=BATCH):
+    feed.batch(chunk)
+    feed.flush()
 
   # Bye all queues!
   rabbit.end_multiple([q0,q00])
 
-  print('[DONE] All input queues are recycled.')
\ No newline at end of file
+  print('[DONE] All input queues are recycled.')
@@ -0,0 +1,72 @@
+"""
+In-memory stand-in of a CouchDB database
+---------------------------
+Implements `update` (`_bulk_docs`) the way couchdb-python
+does: one (success, id, rev or exception) per document,
+a conflict when the revision does not match. Also pages
+through `_all_docs` and Mango `_find` (with bookmarks).
+
+@starcolon projects
+"""
+
+from couchdb.http import ResourceConflict, ResourceNotFound
+from collections import namedtuple
+import uuid
+
+Row = namedtuple('Row',['id','key','doc'])
+
+class StubDb(object):
+  def __init__(self):
+    self.docs     = {}
+    self.requests = 0
+    self.resource = self
+
+  def view(self,name,include_docs=False,limit=None,startkey=None,startkey_docid=None,skip=0):
+    self.requests += 1
+    ids = sorted(i for i in self.docs if startkey is None or i>=startkey)
+    ids = ids[skip:skip+limit] if limit else ids[skip:]
+    return [Row(i,i,dict(self.docs[i])) for i in ids]
+
+  def post_json(self,path,body=None):
+    self.requests += 1
+    if path!='_find': raise ResourceNotFound(('not_found','missing'))
+    ids   = sorted(self.docs)
+    after = body.get('bookmark')
+    if after: ids = [i for i in ids if i>after]
+    ids   = ids[:body['limit']]
+    docs  = [{f: self.docs[i][f] for f in body['fields'] if f in self.docs[i]} for i in ids]
+    return 200,{},{'docs': docs, 'bookmark': ids[-1] if ids else after}
+
+  def update(self,documents):
+    self.requests += 1
+    results = []
+    for doc in documents:
+      _id = doc.get('_id') or uuid.uuid4().hex
+      current = self.docs.get(_id)
+      if current is not None and current['_rev']!=doc.get('_rev'):
+        results.append((False,_id,ResourceConflict(('conflict','Document update conflict.'))))
+        continue
+      n   = int(current['_rev'].split('-')[0])+1 if current else 1
+      rev = '{0}-{1}'.format(n,uuid.uuid4().hex)
+      self.docs[_id] = dict(doc,_id=_id,_rev=rev)
+      results.append((True,_id,rev))
+    return results
+
+# A database which is down
+class DownDb(StubDb):
+  def update(self,documents):
+    self.requests += 1
+    raise ConnectionRefusedError('CouchDB is down')
+
+# A server without Mango `_find` (CouchDB 1.x)
+class NoMangoDb(StubDb):
+  def post_json(self,path,body=None):
+    self.requests += 1
+    raise ResourceNotFound(('not_found','missing'))
+
+# A server whose `_find` has no bookmarks (CouchDB 2.0)
+class NoBookmarkDb(StubDb):
+  def post_json(self,path,body=None):
+    status,headers,data = StubDb.post_json(self,path,body)
+    del data['bookmark']
+    return status,headers,data
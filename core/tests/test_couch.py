@@ -0,0 +1,99 @@
+import tempfile
+import unittest
+import time
+import os
+from pydb import couch
+from pypantip import ledger as Ledger
+from tests.couchstub import StubDb, DownDb, NoMangoDb, NoBookmarkDb
+
+def topic(i):
+  return {'_id': 'topic-{0}'.format(i), 'topic_id': i, 'title': 'T{0}'.format(i)}
+
+class TestBulkWriter(unittest.TestCase):
+  def setUp(self):
+    self.dir    = tempfile.TemporaryDirectory()
+    self.ledger = Ledger.Ledger(os.path.join(self.dir.name,'ledger.json'))
+
+  def tearDown(self):
+    self.dir.cleanup()
+
+  def writer(self,db,**kwargs):
+    return couch.BulkWriter(db,
+      on_failed=lambda t,e: self.ledger.mark_failed(t['topic_id']),
+      on_stored=lambda t,rev: self.ledger.mark_stored(t['topic_id']),
+      **kwargs)
+
+  def test_flush_in_bulk(self):
+    db = StubDb()
+    with self.writer(db,max_docs=3,max_wait=None) as w:
+      for i in range(7): w.push(topic(i))
+      self.assertEqual(db.requests,2)
+      # Buffered, not stored yet
+      self.assertNotIn(6,self.ledger.stored)
+    self.assertEqual(db.requests,3)
+    self.assertEqual(len(db.docs),7)
+    self.assertEqual(w.stored,7)
+    self.assertEqual(self.ledger.summary(),{'stored': 7, 'deleted': 0, 'failed': 0})
+
+  def test_flush_after_max_wait(self):
+    db = StubDb()
+    w  = self.writer(db,max_docs=100,max_wait=0.05)
+    w.push(topic(1))
+    time.sleep(0.3)
+    self.assertEqual(len(db.docs),1)
+    self.assertIn(1,self.ledger.stored)
+    w.close()
+
+  def test_conflicts(self):
+    db = StubDb()
+    db.update([topic(1)])
+    with self.writer(db,max_wait=None) as w:
+      w.push(topic(1))
+      w.push(topic(2))
+    self.assertEqual([_id for _id,_ in w.conflicts],['topic-1'])
+    self.assertIn(1,self.ledger.failed)
+    self.assertIn(2,self.ledger.stored)
+
+  def test_failed_request(self):
+    db = DownDb()
+    with self.writer(db,max_docs=2,max_wait=None) as w:
+      w.push(topic(1))
+      w.push(topic(2))
+      w.push(topic(3))
+    self.assertEqual(w.failures,3)
+    self.assertEqual(self.ledger.summary(),{'stored': 0, 'deleted': 0, 'failed': 3})
+
+  def test_failed_request_in_timer(self):
+    db = DownDb()
+    w  = self.writer(db,max_docs=100,max_wait=0.05)
+    w.push(topic(1))
+    time.sleep(0.3)
+    self.assertEqual(db.requests,1)
+    self.assertIn(1,self.ledger.failed)
+    self.assertNotIn(1,self.ledger.stored)
+    w.close()
+
+class TestStream(unittest.TestCase):
+  def fill(self,db,n=25):
+    db.update([topic(i) for i in range(n)])
+    return db
+
+  def test_view_pages(self):
+    db   = self.fill(StubDb())
+    docs = list(couch.stream(db,page_size=10))
+    self.assertEqual([d['topic_id'] for d in docs],sorted(range(25),key=lambda i: 'topic-{0}'.format(i)))
+
+  def test_find_pages(self):
+    for db in [StubDb(),NoMangoDb(),NoBookmarkDb()]:
+      db   = self.fill(db)
+      docs = list(couch.stream(db,page_size=10,fields=['title','topic_id']))
+      self.assertEqual(len(docs),25,type(db).__name__)
+      self.assertEqual(set(docs[0]),{'title','topic_id'})
+      self.assertEqual(len({d['topic_id'] for d in docs}),25)
+
+  def test_limit(self):
+    db = self.fill(NoMangoDb())
+    self.assertEqual(len(list(couch.stream(db,page_size=10,fields=['title'],limit=12))),12)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+import itertools
+import tempfile
+import unittest
+import numpy as np
+import os
+from pypipe.operations import seglog
+
+class TestSegmentLog(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.log = seglog.create(self.dir.name,'q',segment_bytes=256)
+
+  def tearDown(self):
+    seglog.end(self.log)
+    self.dir.cleanup()
+
+  def fill(self,n=30):
+    feed = seglog.feed([self.log],batch_size=4)
+    for i in range(n): feed({'i': i, 'text': 'ทดสอบ'})
+    feed.flush()
+
+  def test_round_trip_over_segments(self):
+    self.fill()
+    feed = seglog.feed([self.log])
+    feed(np.arange(6,dtype=np.float32).reshape(2,3))
+    feed('plain text')
+    self.assertGreater(len(self.log.bases()),3)
+
+    records = list(seglog.iter(self.log))
+    self.assertEqual(len(records),32)
+    self.assertEqual(records[0],'{"i": 0, "text": "ทดสอบ"}')
+    np.testing.assert_array_equal(records[30],np.arange(6,dtype=np.float32).reshape(2,3))
+    self.assertEqual(records[31],'plain text')
+    # Reading never consumes
+    self.assertEqual(len(list(seglog.iter(self.log))),32)
+
+  def test_chunks(self):
+    self.fill(10)
+    self.assertEqual([len(c) for c in seglog.iter(self.log,chunk=4)],[4,4,2])
+
+  def test_torn_tail(self):
+    self.fill(10)
+    seglog.end(self.log)
+    last = self.log.path_of(self.log.bases()[-1])
+    with open(last,'ab') as f:
+      f.write(seglog.HEADER.pack(100,0,seglog.TEXT) + b'half a rec')
+    # Skipped on read
+    self.assertEqual(len(list(seglog.iter(self.log))),10)
+
+    # Truncated once reopened for writing
+    log  = seglog.create(self.dir.name,'q',segment_bytes=256)
+    seglog.feed([log])('after')
+    self.assertEqual(os.path.getsize(last),seglog.valid_length(last))
+    records = list(seglog.iter(log))
+    self.assertEqual(len(records),11)
+    self.assertEqual(records[-1],'after')
+    seglog.end(log)
+
+  def test_committed_offset(self):
+    self.fill(20)
+    reader = seglog.iter(self.log,json_of,group='trainer')
+    first  = list(itertools.islice(reader,7))
+    reader.close()
+    self.assertEqual([r['i'] for r in first],list(range(7)))
+
+    # Resumes with the record at hand when it stopped
+    rest = list(seglog.iter(self.log,json_of,group='trainer'))
+    self.assertEqual([r['i'] for r in rest],list(range(6,20)))
+    self.assertEqual(self.log.offsets()['trainer'],self.log.end_offset())
+    # Replays from any offset
+    self.assertEqual(len(list(seglog.iter(self.log,offset=0))),20)
+
+  def test_committed_offset_of_chunks(self):
+    self.fill(10)
+    reader = seglog.iter(self.log,json_of,chunk=4,group='trainer')
+    next(reader)
+    next(reader)
+    reader.close()
+    rest = [r['i'] for c in seglog.iter(self.log,json_of,chunk=4,group='trainer') for r in c]
+    self.assertEqual(rest,list(range(4,10)))
+
+  def test_rabbit_keywords(self):
+    self.fill(3)
+    records = seglog.iter(self.log,timeout=0,prefetch=10,ack_every=5,ack_interval=1.0,until=lambda: False)
+    self.assertEqual(len(list(records)),3)
+    with self.assertRaises(TypeError):
+      list(seglog.iter(self.log,chunks=2))
+
+def json_of(record):
+  import json
+  return json.loads(record)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+import re
+from pypantip import scraper
+from pypantip import streamscraper
+from benchcrawl import SAMPLE_PAGE
+
+# The sample page without the element(s) of class [cls]
+def without(cls,html=SAMPLE_PAGE):
+  return re.sub(r'<(\w+) class="{0}">.*?</\1>'.format(cls),'',html,flags=re.S)
+
+class TestEngines(unittest.TestCase):
+  def assertSameRecord(self,html):
+    dom    = scraper.scrape_html(1,html,engine='dom')
+    stream = streamscraper.extract(1,html)
+    self.assertEqual(dom,stream)
+    return stream
+
+  def test_sample_page(self):
+    record = self.assertSameRecord(SAMPLE_PAGE)
+    self.assertTrue(len(record['title'])>0)
+
+  def test_without_tags(self):
+    record = self.assertSameRecord(without('display-post-tag-wrapper'))
+    self.assertEqual(record['tags'],[''])
+
+  def test_without_scores(self):
+    record = self.assertSameRecord(without('emoticon-score',without('like-score')))
+    self.assertEqual((record['vote'],record['react']),(0,0))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -7,11 +7,15 @@ import os
 import sys
 import json
 import argparse
+import time
 import numpy as np
 from termcolor import colored
 from pypipe import pipe as Pipe
 from pypipe import datapipe as DP
+from pypipe import profiling
+from pypipe import memtrack
 from pypipe.operations import rabbit
+from pypipe.operations import seglog
 from pypipe.operations import tapper as T
 from pypipe.operations import cluster
 from pypipe.operations import taghasher
@@ -25,6 +29,8 @@ TAG_HASHER_PATH       = '{0}/data/models/taghash'.format(REPO_DIR)
 CLF_PATH              = '{0}/data/models/clf'.format(REPO_DIR)
 STOPWORDS_PATH        = '{0}/data/words/stopwords.txt'.format(REPO_DIR)
 CSV_REPORT_PATH       = '{0}/data/report.csv'.format(REPO_DIR)
+RUN_REPORT_PATH       = '{0}/data/report.jsonl'.format(REPO_DIR)
+SEGMENT_LOG_DIR       = '{0}/data/seglog'.format(REPO_DIR)
 
 # Prepare training arguments
 arguments = argparse.ArgumentParser()
@@ -35,7 +41,26 @@ arguments.add_argument('--n', type=int, default=None) # Number of decomposed com
 arguments.add_argument('--feat',  type=int, default=None) # Dimension of text feature
 arguments.add_argument('--tagdim', type=int, default=16) # Dimension of tag after hash
 arguments.add_argument('--mod', type=int, default=2) # Modulo of the splitting.  
-args = vars(arguments.parse_args(sys.argv[1:]))
+arguments.add_argument('--profile', type=str, default=None) # Write the stage profiles into this directory
+arguments.add_argument('--profile-mode', dest='profile_mode', type=str, default='cprofile') # [cprofile] or [sample]
+arguments.add_argument('--tracemalloc', dest='tracemalloc', action='store_true') # Also trace the Python heap of each step (slower)
+arguments.add_argument('--transport', type=str, default='mq') # Read the training records from [mq] or replay them from the segment [log]
+arguments.add_argument('--log-dir', dest='log_dir', type=str, default=SEGMENT_LOG_DIR) # Directory of the segment logs
+# Unknown arguments belong to the importing script (e.g. monitor.py)
+args = vars(arguments.parse_known_args(sys.argv[1:])[0])
+
+if args['profile']:
+  profiling.enable(args['profile'],args['profile_mode'])
+
+# The training records come either from the MQs (consumed),
+# or from the segment log written by process.py (replayed
+# from the beginning, as many times as needed)
+relay = seglog if args['transport']=='log' else rabbit
+
+def open_source(q):
+  if args['transport']=='log':
+    return seglog.create(args['log_dir'],'pantip-x')
+  return rabbit.create('localhost',q)
 
 def load_stopwords():
   if (os.path.isfile(STOPWORDS_PATH)):
@@ -47,12 +72,16 @@ def load_stopwords():
 
 # Convert the MQ record to an X vector (text only for hashing)
 def take_x1(record):
-  data = json.loads(record)
+  return text_of(json.loads(record))
+
+def take_tags(record):
+  return tags_of(json.loads(record))
+
+def text_of(data):
   x = str(data['title'] + data['topic']) #TAOTOREVIEW: Any better compositon?
   return x
 
-def take_tags(record):
-  data = json.loads(record)
+def tags_of(data):
   x = ' '.join([tag for tag in data['tags'] if len(tag)>1])
   return x
 
@@ -106,7 +135,7 @@ def train_sentiment_capture(stopwords,save=False):
   # STEP#1 : [text] => [numeric vectors]
   #------------------------------------
   # Vectorise the input topic (text only) 
-  mqx1     = rabbit.create('localhost','pantip-x1')
+  mqx1     = open_source('pantip-x1')
   topicHasher = texthasher.safe_load(
     TEXT_VECTORIZER_PATH,
     stop_words=stopwords,
@@ -117,16 +146,15 @@ def train_sentiment_capture(stopwords,save=False):
 
   print(colored('#STEP-1 started ...','cyan'))
   print('hasher : {0}'.format(topicHasher))
-  iterX = DP.pipe(
-    rabbit.iter(mqx1,take_x1),
-    dests=None,
-    transform=hashMe,
-    title='Vectorisation'
-  )
-
-  rabbit.end(mqx1)
+  with memtrack.step('Vectorisation'):
+    iterX = DP.pipe(
+      relay.iter(mqx1,take_x1),
+      dests=None,
+      transform=hashMe,
+      title='Vectorisation'
+    )
 
-  vecX = [x for x in iterX]
+  relay.end(mqx1)
 
   print(colored('#STEP-1 finished ...','cyan'))
 
@@ -140,38 +168,38 @@ def train_sentiment_capture(stopwords,save=False):
     TAG_HASHER_PATH,
     n_feature=args['tagdim']
   )
-  mqx2      = rabbit.create('localhost','pantip-x2')
+  mqx2      = open_source('pantip-x2')
   hashtagMe = taghasher.hash(tagHasher,learn=True)
-  vectags   = DP.pipe(
-    [tag for tag in rabbit.iter(mqx2,take_tags)],
-    dests=None,
-    transform=hashtagMe,
-    title='Tag Vectorising'
-  )
+  with memtrack.step('Tag Vectorising'):
+    vectags = DP.pipe(
+      relay.iter(mqx2,take_tags),
+      dests=None,
+      transform=hashtagMe,
+      title='Tag Vectorising'
+    )
 
-  rabbit.end(mqx2)  
+  relay.end(mqx2)  
   
   # STEP#3 : [X] = [vectorised text] : [vectorised tags]
   #----------------------------------------
   # Join each of the component together
   # Assembly a training vector
-  mqy = rabbit.create('localhost','pantip-x3')
-  Y = [y for y in rabbit.iter(mqy,take_sentiment_score)]
-
-  XS = zip(
-    list(vectags),
-    list(vecX)
-  )
+  mqy = open_source('pantip-x3')
+  Y = [y for y in relay.iter(mqy,take_sentiment_score)]
 
-  X = [list(a) + list(b) for a,b in XS]
+  # Rows are joined straight into one matrix
+  with profiling.stage('Feature assembly'), memtrack.step('Feature assembly'):
+    X = DP.hstack(vectags,iterX)
+    memtrack.note('X',X)
 
-  rabbit.end(mqy)
+  relay.end(mqy)
 
   # Train!
   print(colored('Training process started...','cyan'))
   clf     = cluster.safe_load(CLF_PATH,args['cluster'],args['feat'])
   trainMe = cluster.analyze(clf,labels=Y)
-  (Yact, Ypred) = trainMe(X, test_ratio=0.33)
+  with profiling.stage('Training'):
+    (Yact, Ypred) = trainMe(X, test_ratio=0.33)
   print(colored('[DONE]','yellow'))
 
   # Cross validation
@@ -207,6 +235,18 @@ def train_sentiment_capture(stopwords,save=False):
       ','.join(lbl_predict_rate) #6
     ))
 
+  # Record the run along with the memory taken by each step
+  memtrack.report()
+  with open(RUN_REPORT_PATH,'a') as report:
+    report.write(json.dumps({
+      'time':     time.strftime('%Y-%m-%dT%H:%M:%S'),
+      'args':     args,
+      'accuracy': predict_rate,
+      'accuracy_by_class': {str(lbl): float(r) for lbl,r in zip(labels,lbl_predict_rate)},
+      'max_rss':  memtrack.max_rss(),
+      'steps':    memtrack.steps
+    }) + '\n')
+
   #Save the trained models
   if save:
     print(colored('Saving models...','cyan'))
@@ -216,57 +256,55 @@ def train_sentiment_capture(stopwords,save=False):
     print(colored('[DONE]','green'))
 
 
-# def load_models():
-#   topicHasher = texthasher.safe_load(TEXT_VECTORIZER_PATH,stop_words=[])
-#   tagHasher   = taghasher.safe_load(TAG_HASHER_PATH,n_feature=256)
-#   clf         = cluster.safe_load(CLF_PATH)
-#   return (topicHasher,taghasher,contentClf,clf)
+# Load the trained models
+# @return {tuple} of (topic hasher, tag hasher, classifier)
+def load_models():
+  topicHasher = texthasher.safe_load(TEXT_VECTORIZER_PATH,stop_words=[])
+  tagHasher   = taghasher.safe_load(TAG_HASHER_PATH,n_feature=args['tagdim'])
+  clf         = cluster.safe_load(CLF_PATH,args['cluster'],args['feat'])
+  return (topicHasher,tagHasher,clf)
+
+# Classify a batch of tokenised topics at once, each step
+# (vectorisation, tag vectorising, prediction) runs
+# a single call over the whole batch.
+# The features are assembled as in the training.
+# @param {list} of topic records (dict)
+# @return {list} of predicted classes
+def classify_text(topicHasher,tagHasher,clf):
+  hashMe     = profiling.wrap('Vectorisation',texthasher.hash(topicHasher,learn=False))
+  hashtagMe  = profiling.wrap('Tag Vectorising',taghasher.hash(tagHasher,learn=False))
+  classifyMe = profiling.wrap('Classification',cluster.analyze(clf))
+
+  def _classify(topics):
+    if len(topics)==0: return []
+    vectags = hashtagMe([tags_of(t) for t in topics])
+    vecX    = hashMe([text_of(t) for t in topics])
+    X = DP.hstack(vectags,vecX)
+    return list(classifyMe(X))
+  return _classify
 
 # @param {iterable} topics
-def classifYpredtext(topicHasher,tagHasher,contentClf,clf):
+# @param {int} chunk_size, number of topics classified at once
+def classifYpredtext(topicHasher,tagHasher,contentClf,clf,chunk_size=256):
+  # Prepare operations
+  hashMe     = profiling.wrap('Vectorisation',texthasher.hash(topicHasher,learn=False))
+  clusterMe  = profiling.wrap('Clustering',textcluster.classify(contentClf,learn=False))
+  hashtagMe  = profiling.wrap('Tag Vectorising',taghasher.hash(tagHasher,learn=False))
+  classifyMe = profiling.wrap('Classification',cluster.analyze(clf))
+
+  # Only one chunk of the topics is held in memory at a time
   def _classify(textsrc):
     print(colored('[Classifying]...','green'))
-    # Prepare operations
-    hashMe     = texthasher.hash(topicHasher,learn=False)
-    clusterMe  = textcluster.classify(contentClf,learn=False)
-    hashtagMe  = taghasher.hash(tagHasher,learn=False)
-    classifyMe = cluster.analyze(clf)
-  
-    iterX = DP.pipe(
-      [take_x1(x) for x in textsrc],
-      dests=None,
-      transform=hashMe,
-      title='Vectorisation'
-    )
-
-    vecX = [x for x in iterX]
-
-    clusters = DP.pipe(
-      [x for x in vecX],
-      dests=None,
-      transform=clusterMe,
-      title='Clustering'
-    )
-
-    vectags   = DP.pipe(
-      [take_tags(x) for x in textsrc],
-      dests=None,
-      transform=hashtagMe,
-      title='Tag Vectorising'
-    )
+    for chunk in Pipe.chunks(DP.read(textsrc),chunk_size):
+      vecX     = list(hashMe([take_x1(x) for x in chunk]))
+      clusters = clusterMe(vecX)
+      vectags  = hashtagMe([take_tags(x) for x in chunk])
 
-    XS = zip(
-      list(vectags),
-      [[i] for i in clusters], # Make scalar a single-element vector
-      list(vecX)
-    )
-    X = [list(a) + list(b) + list(c) for a,b,c in XS]
+      # Make scalar a single-element vector
+      X = DP.hstack(vectags,[[i] for i in clusters],vecX)
 
-    # Analyse 
-    Ypred = classifyMe(X)
-
-    # Returns the results as tuples
-    return zip(Ypred,X)
+      # Analyse, the results come as tuples
+      yield from zip(classifyMe(X),X)
   return _classify
 
 
@@ -277,6 +315,9 @@ if __name__ == '__main__':
   # Load stop words from text file
   stopwords = load_stopwords()
 
+  # Track the memory of the training steps
+  memtrack.enable(trace=args['tracemalloc'])
+
   # Start the training process
   print(colored('Training centroid model ...','cyan'))
   output = train_sentiment_capture(stopwords,save=args['save'])
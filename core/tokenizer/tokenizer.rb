@@ -7,7 +7,7 @@ require 'thailang4r/word_breaker'
 require 'sinatra'
 require 'json'
 
-set :port, 9861
+set :port, (ENV['TOKENIZER_PORT'] || 9861).to_i
 $word_breaker = ThaiLang::WordBreaker.new 
 
 puts "==========================="
@@ -26,8 +26,12 @@ def break_me(str)
   $word_breaker.break_into_words(str)
 end
 
+# The tokenisations are cached under this version,
+# it changes along with the word breaker (and its dictionary)
+$version = "0.0.1alpha+thailang4r-#{Gem.loaded_specs['thailang4r'].version}"
+
 get '/version/' do
-  puts '0.0.1alpha'
+  $version
 end
 
 post '/break/' do
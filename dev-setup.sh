@@ -2,12 +2,8 @@
 
 echo Collecting libraries...
 
-pip3 install multiprocessing
-pip3 install argparse
-pip3 install htmldom
-pip3 install couchdb
+pip3 install -r requirements.txt
 pip3 install flask
-pip3 install pika
 
 gem install thailang4r
 gem install sinatra